@@ -1,12 +1,25 @@
-from collections import defaultdict
+import base64
+import json
+import re
+import time
+from collections import OrderedDict, defaultdict
+from copy import copy
 from importlib import import_module
+from threading import RLock
 
 from django.conf import settings
-from elasticsearch.client import Elasticsearch
+from django.core.exceptions import FieldDoesNotExist
+from elasticsearch.exceptions import TransportError
+from elasticsearch_dsl.query import Q
+from elasticsearch_dsl.result import Response
 from elasticsearch_dsl.search import Search
 from six import iteritems, itervalues, string_types
 
-from .aliases import SearchAlias
+from .aio import AsyncResultsIterator, run_in_executor
+from .aliases import SearchAlias, SearchAliasAttribute
+from .breaker import ClusterUnhealthy, is_unavailable
+from .cache import get_search_cache
+from .connections import HEALTH_CHECK_BACKOFF, registry
 from .indices import ModelIndex
 from .logger import logger
 
@@ -17,63 +30,137 @@ class Bungiesearch(Search):
     '''
     DEFAULT_TIMEOUT = 5
     BUNGIE = settings.BUNGIESEARCH
+    # Indices rebuilt by `search_index --reindex-from-source` are named after the index in the settings and a timestamp.
+    REBUILT_INDEX_FORMAT = '{}_%Y%m%d%H%M%S'
+    REBUILT_INDEX_PATTERN = re.compile(r'^(.+)_\d{14}$')
+
+    # Maps BUNGIESEARCH['CONNECTION'] keys to the corresponding elasticsearch client parameters.
+    CONNECTION_SETTINGS = {'MAXSIZE': 'maxsize', 'SNIFF_ON_START': 'sniff_on_start', 'SNIFF_ON_CONNECTION_FAIL': 'sniff_on_connection_fail',
+                           'SNIFFER_TIMEOUT': 'sniffer_timeout', 'MAX_RETRIES': 'max_retries', 'RETRY_ON_TIMEOUT': 'retry_on_timeout'}
 
     # The following code loads each model index_name module (as defined in the settings) and stores
     # index_name name to model index_name, and index_name name to model. Settings shouldn't change between
-    # subsequent calls to Search(), which is why this is static code.
+    # subsequent calls to Search(), which is why this is static code. Each index is only loaded when first needed, and
+    # each ModelIndex is only instantiated when first needed.
 
-    _cached_es_instances = {}
     # Let's go through the settings in order to map each defined Model/ModelIndex to the elasticsearch index_name.
-    _model_to_index, _model_name_to_index, _model_name_to_model_idx = defaultdict(list), defaultdict(list), defaultdict(list)
-    _index_to_model, _idx_name_to_mdl_to_mdlidx = defaultdict(list), defaultdict(dict)
-    _model_name_to_default_index, _alias_hooks = {}, {}
+    _model_to_index, _model_name_to_index = defaultdict(list), defaultdict(list)
+    # ModelIndex classes, and their instances once instantiated, per index name and model name.
+    _index_to_model, _idx_name_to_mdl_to_mdlidx_cls, _idx_name_to_mdl_to_mdlidx = defaultdict(list), defaultdict(dict), defaultdict(dict)
+    # Name of the index of the default ModelIndex of each model name.
+    _model_name_to_default_index, _alias_hooks, _alias_applicability = {}, {}, {}
     _managed_models = []
-    __loaded_indices__ = False
+    _loaded_indices, _loaded_aliases = set(), False
+    _load_lock = RLock()
+    # List of (kind, name, seconds) tuples recording the time spent loading each module and ModelIndex.
+    _load_timings = []
 
     @classmethod
     def __load_settings__(cls):
-        if cls.__loaded_indices__:
+        '''
+        Loads all the indices and aliases defined in the settings.
+        '''
+        cls._load_indices()
+        cls._load_aliases()
+
+    @classmethod
+    def _load_indices(cls):
+        for index_name in cls.BUNGIE['INDICES']:
+            cls._load_index(index_name)
+
+    @classmethod
+    def _load_index(cls, index_name):
+        '''
+        Imports the module of the provided index and registers each of its ModelIndex, unless already done.
+        :raise KeyError: If the index is not defined in the settings.
+        '''
+        if index_name in cls._loaded_indices:
             return
-        cls.__loaded_indices__ = True
 
-        # Loading indices.
-        for index_name, module_str in iteritems(cls.BUNGIE['INDICES']):
+        with cls._load_lock:
+            if index_name in cls._loaded_indices:
+                return
+            try:
+                module_str = cls.BUNGIE['INDICES'][index_name]
+            except KeyError:
+                raise KeyError('Could not find any index named {}. Is this index defined in BUNGIESEARCH["INDICES"]?'.format(index_name))
+
+            start = time.time()
             index_module = import_module(module_str)
+            cls._load_timings.append(('import', module_str, time.time() - start))
             for index_obj in itervalues(index_module.__dict__):
                 try:
                     if issubclass(index_obj, ModelIndex) and index_obj != ModelIndex:
-                        index_instance = index_obj()
-                        assoc_model = index_instance.get_model()
+                        # Only the Meta of the ModelIndex is read here: it is instantiated when first needed.
+                        try:
+                            _meta = getattr(index_obj, 'Meta')
+                        except AttributeError:
+                            raise AttributeError('ModelIndex {} does not contain a Meta class.'.format(index_obj.__name__))
+                        assoc_model = _meta.model
                         cls._index_to_model[index_name].append(assoc_model)
-                        cls._model_name_to_model_idx[assoc_model.__name__].append(index_instance)
-                        cls._idx_name_to_mdl_to_mdlidx[index_name][assoc_model.__name__] = index_instance
-                        if index_instance.is_default:
+                        cls._idx_name_to_mdl_to_mdlidx_cls[index_name][assoc_model.__name__] = index_obj
+                        if getattr(_meta, 'default', True):
                             if assoc_model.__name__ in cls._model_name_to_default_index:
-                                raise AttributeError('ModelIndex {} on index {} is marked as default, but {} was already set as default.'.format(index_instance, index_name, cls._model_name_to_default_index[assoc_model.__name__]))
-                            cls._model_name_to_default_index[assoc_model.__name__] = index_instance
+                                raise AttributeError('ModelIndex {} on index {} is marked as default, but the one on index {} was already set as default.'.format(index_obj.__name__, index_name, cls._model_name_to_default_index[assoc_model.__name__]))
+                            cls._model_name_to_default_index[assoc_model.__name__] = index_name
+                        # Reverse maps in order to have O(1) access.
+                        cls._model_to_index[assoc_model].append(index_name)
+                        cls._model_name_to_index[assoc_model.__name__].append(index_name)
                 except TypeError:
                     pass # Oops, just attempted to get subclasses of a non-class.
+            cls._loaded_indices.add(index_name)
+            logger.debug('Loaded index {} from {}.'.format(index_name, module_str))
 
-        # Create reverse maps in order to have O(1) access.
-        for index_name, models in iteritems(cls._index_to_model):
-            for model in models:
-                cls._model_to_index[model].append(index_name)
-                cls._model_name_to_index[model.__name__].append(index_name)
-
-        # Loading aliases.
-        for alias_prefix, module_str in iteritems(cls.BUNGIE.get('ALIASES', {})):
-            if alias_prefix is None:
-                alias_prefix = 'bungie'
-            if alias_prefix != '':
-                alias_prefix += '_'
-            alias_module = import_module(module_str)
-            for alias_obj in itervalues(alias_module.__dict__):
-                try:
-                    if issubclass(alias_obj, SearchAlias) and alias_obj != SearchAlias:
-                        alias_instance = alias_obj()
-                        cls._alias_hooks[alias_prefix + alias_instance.alias_name] = alias_instance
-                except TypeError:
-                    pass # Oops, just attempted to get subclasses of a non-class.
+    @classmethod
+    def _get_model_index(cls, index_name, model_name):
+        '''
+        Returns the ModelIndex of this model on this index, which is instantiated the first time it is needed.
+        '''
+        instances = cls._idx_name_to_mdl_to_mdlidx[index_name]
+        if model_name not in instances:
+            with cls._load_lock:
+                if model_name not in instances:
+                    index_cls = cls._idx_name_to_mdl_to_mdlidx_cls[index_name][model_name]
+                    start = time.time()
+                    index_instance = index_cls()
+                    cls._load_timings.append(('model index', '{}.{}'.format(index_name, index_cls.__name__), time.time() - start))
+                    instances[model_name] = index_instance
+        return instances[model_name]
+
+    @classmethod
+    def _load_aliases(cls):
+        '''
+        Imports the search alias modules and registers each SearchAlias, unless already done.
+        '''
+        if cls._loaded_aliases:
+            return
+
+        with cls._load_lock:
+            if cls._loaded_aliases:
+                return
+            for alias_prefix, module_str in iteritems(cls.BUNGIE.get('ALIASES', {})):
+                if alias_prefix is None:
+                    alias_prefix = 'bungie'
+                if alias_prefix != '':
+                    alias_prefix += '_'
+                start = time.time()
+                alias_module = import_module(module_str)
+                cls._load_timings.append(('import', module_str, time.time() - start))
+                for alias_obj in itervalues(alias_module.__dict__):
+                    try:
+                        if issubclass(alias_obj, SearchAlias) and alias_obj != SearchAlias:
+                            alias_instance = alias_obj()
+                            alias_name = alias_prefix + alias_instance.alias_name
+                            cls._alias_hooks[alias_name] = alias_instance
+                            # Applicable models and doctypes, None if the alias applies to all of them.
+                            if alias_instance._applicable_models:
+                                cls._alias_applicability[alias_name] = (frozenset(alias_instance._applicable_models), frozenset(model.__name__ for model in alias_instance._applicable_models))
+                            # Attributes of the search take precedence over aliases, as with __getattr__.
+                            if not hasattr(Bungiesearch, alias_name):
+                                setattr(Bungiesearch, alias_name, SearchAliasAttribute(alias_name))
+                    except TypeError:
+                        pass # Oops, just attempted to get subclasses of a non-class.
+            cls._loaded_aliases = True
 
     @classmethod
     def _build_key(cls, urls, timeout, **settings):
@@ -94,6 +181,48 @@ class Bungiesearch(Search):
         key = (urls, timeout, settings)
         return key
 
+    @classmethod
+    def get_urls(cls, write=False, index=None):
+        '''
+        Returns the elasticsearch URLs to use for reading (searches) or writing (indexing and index management).
+        Looks up BUNGIESEARCH['INDEX_URLS'][index]['READ' or 'WRITE'], then BUNGIESEARCH['READ_URLS' or 'WRITE_URLS'], then
+        BUNGIESEARCH['URLS'].
+        :param write: set to True to get the URLs used to write.
+        :param index: index name, if any.
+        '''
+        key = 'WRITE' if write else 'READ'
+        if index is not None:
+            urls = cls.BUNGIE.get('INDEX_URLS', {}).get(index, {}).get(key)
+            if urls:
+                return urls
+        return cls.BUNGIE.get('{}_URLS'.format(key)) or cls.BUNGIE['URLS']
+
+    @classmethod
+    def get_write_es_instance(cls, index=None, timeout=None):
+        '''
+        Returns the low level elasticsearch instance used to write to the provided index.
+        :param index: index name, if any.
+        :param timeout: timeout of the connection, defaults to BUNGIESEARCH['TIMEOUT'].
+        '''
+        return cls._get_es_instance(cls.get_urls(write=True, index=index), timeout or cls.BUNGIE.get('TIMEOUT', cls.DEFAULT_TIMEOUT), False, {})
+
+    @classmethod
+    def _get_es_instance(cls, urls, timeout, force_new, es_settings):
+        '''
+        Returns the elasticsearch client for these settings from the connection registry.
+        '''
+        if not es_settings:
+            # If there aren't any provided elasticsearch settings, let's see if it's defined in the settings.
+            es_settings = cls.BUNGIE.get('ES_SETTINGS', {})
+
+        connection = cls.BUNGIE.get('CONNECTION', {})
+        client_settings = dict((cls.CONNECTION_SETTINGS[k], v) for k, v in iteritems(connection) if k in cls.CONNECTION_SETTINGS)
+        client_settings.update(es_settings)
+
+        # Building a caching key to cache the es_instance for later use (and retrieved a previously cached es_instance).
+        cache_key = cls._build_key(urls, timeout, **client_settings)
+        return registry.get(cache_key, urls, timeout, force_new=force_new, **client_settings)
+
     @classmethod
     def get_index(cls, model, via_class=False):
         '''
@@ -102,6 +231,7 @@ class Bungiesearch(Search):
         :param via_class: set to True if parameter model is a class.
         :raise KeyError: If the provided model does not have any index associated.
         '''
+        cls._load_indices()
         try:
             return cls._model_to_index[model] if via_class else cls._model_name_to_index[model]
         except KeyError:
@@ -114,10 +244,11 @@ class Bungiesearch(Search):
         :param model: model name as a string.
         :raise KeyError: If the provided model does not have any index associated.
         '''
+        cls._load_indices()
         try:
             if default:
-                return cls._model_name_to_default_index[model]
-            return cls._model_name_to_model_idx[model]
+                return cls._get_model_index(cls._model_name_to_default_index[model], model)
+            return [cls._get_model_index(index_name, model) for index_name in cls._model_name_to_index[model]]
         except KeyError:
             raise KeyError('Could not find any model index defined for model {}.'.format(model))
 
@@ -126,7 +257,20 @@ class Bungiesearch(Search):
         '''
         Returns the list of indices defined in the settings.
         '''
-        return cls._idx_name_to_mdl_to_mdlidx.keys()
+        return list(cls.BUNGIE['INDICES'].keys())
+
+    @classmethod
+    def get_settings_index(cls, index):
+        '''
+        Returns the name in the settings of an index returned by elasticsearch. These differ for indices rebuilt with
+        `search_index --reindex-from-source`, which are named after the index in the settings with a timestamp suffix.
+        :param index: index name, as returned by elasticsearch.
+        '''
+        if index not in cls.BUNGIE['INDICES']:
+            match = cls.REBUILT_INDEX_PATTERN.match(index)
+            if match and match.group(1) in cls.BUNGIE['INDICES']:
+                return match.group(1)
+        return index
 
     @classmethod
     def get_models(cls, index, as_class=False):
@@ -135,10 +279,8 @@ class Bungiesearch(Search):
         :param index: index name.
         :param as_class: set to True to return the model as a model object instead of as a string.
         '''
-        try:
-            return cls._index_to_model[index] if as_class else cls._idx_name_to_mdl_to_mdlidx[index].keys()
-        except KeyError:
-            raise KeyError('Could not find any index named {}. Is this index defined in BUNGIESEARCH["INDICES"]?'.format(index))
+        cls._load_index(index)
+        return cls._index_to_model[index] if as_class else list(cls._idx_name_to_mdl_to_mdlidx_cls[index].keys())
 
     @classmethod
     def get_model_indices(cls, index):
@@ -146,10 +288,23 @@ class Bungiesearch(Search):
         Returns the list of model indices (i.e. ModelIndex objects) defined for this index.
         :param index: index name.
         '''
-        try:
-            return cls._idx_name_to_mdl_to_mdlidx[index].values()
-        except KeyError:
-            raise KeyError('Could not find any index named {}. Is this index defined in BUNGIESEARCH["INDICES"]?'.format(index))
+        cls._load_index(index)
+        return [cls._get_model_index(index, model_name) for model_name in cls._idx_name_to_mdl_to_mdlidx_cls[index]]
+
+    @classmethod
+    def _applicable_lookups(cls, model, lookups):
+        '''
+        Returns the related lookups which start with a field of the provided model. This allows a search on several
+        doc types to specify related lookups which only exist on some of the models.
+        '''
+        applicable = []
+        for lookup in lookups:
+            try:
+                model._meta.get_field(getattr(lookup, 'prefetch_through', lookup).split('__')[0])
+            except FieldDoesNotExist:
+                continue
+            applicable.append(lookup)
+        return applicable
 
     @classmethod
     def map_raw_results(cls, raw_results, instance=None):
@@ -169,20 +324,41 @@ class Bungiesearch(Search):
         found_results = {}
         for pos, result in enumerate(raw_results):
             model_name = result.meta.doc_type
-            if model_name not in Bungiesearch._model_name_to_index or result.meta.index not in Bungiesearch._model_name_to_index[model_name]:
+            index_name = cls.get_settings_index(result.meta.index)
+            if index_name in cls.BUNGIE['INDICES']:
+                cls._load_index(index_name)
+            if model_name not in Bungiesearch._model_name_to_index or index_name not in Bungiesearch._model_name_to_index[model_name]:
                 logger.warning('Returned object of type {} ({}) is not defined in the settings, or is not associated to the same index as in the settings.'.format(model_name, result))
                 results[pos] = result
             else:
-                meta = Bungiesearch.get_model_index(model_name).Meta
-                model_results['{}.{}'.format(result.meta.index, model_name)].append(result.meta.id)
-                found_results['{1.meta.index}.{0}.{1.meta.id}'.format(model_name, result)] = (pos, result.meta)
+                model_results['{}.{}'.format(index_name, model_name)].append(result.meta.id)
+                # The same document may be returned several times when mapping the results of several searches at once.
+                found_results.setdefault('{}.{}.{}'.format(index_name, model_name, result.meta.id), []).append((pos, result.meta))
 
         # Now that we have model ids per model name, let's fetch everything at once.
         for ref_name, ids in iteritems(model_results):
             index_name, model_name = ref_name.split('.')
-            model_idx = Bungiesearch._idx_name_to_mdl_to_mdlidx[index_name][model_name]
+            model_idx = Bungiesearch._get_model_index(index_name, model_name)
             model_obj = model_idx.get_model()
             items = model_obj.objects.filter(pk__in=ids)
+
+            # Related objects are those requested on the instance, or the defaults of the ModelIndex.
+            select_related, prefetch_related = model_idx.select_related, model_idx.prefetch_related
+            if instance and instance._select_related:
+                select_related = instance._select_related
+            if instance and instance._prefetch_related:
+                prefetch_related = instance._prefetch_related
+            if select_related is True:
+                items = items.select_related()
+            elif select_related:
+                select_related = cls._applicable_lookups(model_obj, select_related)
+                if select_related:
+                    items = items.select_related(*select_related)
+            if prefetch_related:
+                prefetch_related = cls._applicable_lookups(model_obj, prefetch_related)
+                if prefetch_related:
+                    items = items.prefetch_related(*prefetch_related)
+
             if instance:
                 if instance._only == '__model' or model_idx.optimize_queries:
                     desired_fields = model_idx.fields_to_fetch
@@ -192,6 +368,9 @@ class Bungiesearch(Search):
                     desired_fields = instance._only
 
                 if desired_fields: # Prevents setting the database fetch to __fields but not having specified any field to elasticsearch.
+                    if select_related and select_related is not True:
+                        # Relations followed with select_related cannot be deferred.
+                        desired_fields = list(desired_fields) + [lookup.split('__')[0] for lookup in select_related]
                     items = items.only(
                         *[field.name
                           for field in model_obj._meta.get_fields()
@@ -203,12 +382,72 @@ class Bungiesearch(Search):
                     )
             # Let's reposition each item in the results and set the _searchmeta meta information.
             for item in items:
-                pos, meta = found_results['{}.{}.{}'.format(index_name, model_name, item.pk)]
-                item._searchmeta = meta
-                results[pos] = item
+                for num, (pos, meta) in enumerate(found_results['{}.{}.{}'.format(index_name, model_name, item.pk)]):
+                    if num:
+                        item = copy(item)
+                    item._searchmeta = meta
+                    results[pos] = item
 
         return results
 
+    @classmethod
+    def multi_execute(cls, searches, raise_on_error=True):
+        '''
+        Executes several searches in one request with elasticsearch's multi search API, and maps their results.
+        Searches which share the same `.only()` settings are mapped together, i.e. with one database fetch per model.
+        :param searches: list of Bungiesearch instances. One request is sent per elasticsearch client they read from.
+        :param raise_on_error: set to False to set the results of failed searches to None instead of raising a TransportError.
+        :return: list of the results of each search, in the same order as `searches`.
+        '''
+        if not searches:
+            return []
+
+        # Searches are sent with one request per elasticsearch client, since indices may have different read URLs.
+        requests = OrderedDict()
+        for pos, search in enumerate(searches):
+            header = {}
+            if search._index:
+                header['index'] = search._index
+            if search._doc_type:
+                header['type'] = search._doc_type
+            header.update(search._params)
+            es = search._read_search().get_es_instance()
+            positions, body = requests.setdefault(id(es), (es, [], []))[1:]
+            positions.append(pos)
+            body.extend([header, search._execution_search().to_dict()])
+
+        responses = [None] * len(searches)
+        for es, positions, body in itervalues(requests):
+            for pos, response in zip(positions, cls._call_es(es, es.msearch, body=body)['responses']):
+                responses[pos] = response
+
+        to_map = defaultdict(list)
+        for search, response in zip(searches, responses):
+            if response.get('error', False):
+                if raise_on_error:
+                    raise TransportError('N/A', response['error'].get('type', 'N/A') if isinstance(response['error'], dict) else response['error'], response['error'])
+                search.results = None
+                continue
+
+            search._response = Response(response, callbacks=search._doc_type_map)
+            search.raw_results = search._response
+            search._count = search.raw_results.hits.total
+            if search._raw_results_only:
+                search.results = search.raw_results
+            else:
+                to_map[repr((search._only, search._fields, search._select_related, search._prefetch_related))].append(search)
+
+        for group in itervalues(to_map):
+            hits = [hit for search in group for hit in search.raw_results.hits]
+            mapped = cls.map_raw_results(hits, group[0])
+            start = 0
+            for search in group:
+                stop = start + len(search.raw_results.hits)
+                search.results = mapped[start:stop]
+                start = stop
+
+        return [search.results for search in searches]
+
     def __init__(self, urls=None, timeout=None, force_new=False, raw_results=False, **kwargs):
         '''
         Creates a new ElasticSearch DSL object. Grabs the ElasticSearch connection from the pool
@@ -224,9 +463,9 @@ class Bungiesearch(Search):
         :param **kwargs: Additional settings to pass to the low level elasticsearch client and to elasticsearch-sal-py.search.Search.
         '''
 
-        Bungiesearch.__load_settings__()
-
-        urls = urls or Bungiesearch.BUNGIE['URLS']
+        # Searches configured from the settings may be routed to the read URLs of the searched index when executed.
+        routed = urls is None and 'using' not in kwargs
+        urls = urls or Bungiesearch.get_urls()
         if not timeout:
             timeout = Bungiesearch.BUNGIE.get('TIMEOUT', Bungiesearch.DEFAULT_TIMEOUT)
 
@@ -238,30 +477,25 @@ class Bungiesearch(Search):
             else:
                 es_settings[k] = v
 
-        if not es_settings:
-            # If there aren't any provided elasticsearch settings, let's see if it's defined in the settings.
-            es_settings = Bungiesearch.BUNGIE.get('ES_SETTINGS', {})
-
-        # Building a caching key to cache the es_instance for later use (and retrieved a previously cached es_instance).
-        cache_key = Bungiesearch._build_key(urls, timeout, **es_settings)
-        es_instance = None
-        if not force_new:
-            if cache_key in Bungiesearch._cached_es_instances:
-                es_instance = Bungiesearch._cached_es_instances[cache_key]
-
-        if not es_instance:
-            es_instance = Elasticsearch(urls, timeout=timeout, **es_settings)
-            Bungiesearch._cached_es_instances[cache_key] = es_instance
-
         if 'using' not in search_settings:
-            search_settings['using'] = es_instance
+            search_settings['using'] = Bungiesearch._get_es_instance(urls, timeout, force_new, es_settings)
 
         super(Bungiesearch, self).__init__(**search_settings)
 
+        if 'PREFERENCE' in Bungiesearch.BUNGIE:
+            self._params['preference'] = Bungiesearch.BUNGIE['PREFERENCE']
+
         # Creating instance attributes.
         self._only = [] # Stores the exact fields to fetch from the database when mapping.
         self.results = [] # Store the mapped and unmapped results.
+        self.raw_results = None # Response of elasticsearch once executed, None if not executed or if the database fallback was used.
         self._raw_results_only = raw_results
+        self._count = None # Caches the total number of hits, either from a count request or from an executed search.
+        self._cache_ttl = None # Time to live of the cached raw response, None if the response must not be cached.
+        self._select_related = [] # Related objects to select when mapping, or True for all of them.
+        self._prefetch_related = [] # Related objects to prefetch when mapping.
+        self._fetch_source = False # Forces elasticsearch to return `_source` even if results are mapped to the database.
+        self._routing = (timeout, es_settings) if routed else None # Client settings used to route the search to the read URLs of its index.
 
     def _clone(self):
         '''
@@ -269,6 +503,11 @@ class Bungiesearch(Search):
         '''
         instance = super(Bungiesearch, self)._clone()
         instance._raw_results_only = self._raw_results_only
+        instance._cache_ttl = self._cache_ttl
+        instance._select_related = self._select_related if self._select_related is True else list(self._select_related)
+        instance._prefetch_related = list(self._prefetch_related)
+        instance._fetch_source = self._fetch_source
+        instance._routing = self._routing
         return instance
 
     def get_es_instance(self):
@@ -277,8 +516,89 @@ class Bungiesearch(Search):
         '''
         return self._using
 
+    def _read_search(self):
+        '''
+        Returns this search using the client of the read URLs of the searched indices, if these are overwritten in
+        BUNGIESEARCH['INDEX_URLS'] and if this search was not given explicit URLs or client.
+        '''
+        if self._routing is None or not self._index or 'INDEX_URLS' not in self.BUNGIE:
+            return self
+        urls = [self.get_urls(index=index) for index in self._index]
+        if any(index_urls != urls[0] for index_urls in urls[1:]):
+            logger.debug('Indices {} have different read URLs: using the default ones.'.format(self._index))
+            return self
+        timeout, es_settings = self._routing
+        es_instance = self._get_es_instance(urls[0], timeout, False, es_settings)
+        if es_instance is self._using:
+            return self
+        return self.using(es_instance)
+
+    def _execution_search(self):
+        '''
+        Returns the search to send to elasticsearch. Mapping results to the database only requires the metadata of each
+        hit, hence `_source` is not requested unless raw results, `fields`, `source` or `fetch_source` are used.
+        '''
+        search = self._read_search()
+        if self._raw_results_only or self._fetch_source or self._source or self._fields is not None or '_source' in self._extra:
+            return search
+        return search.extra(_source=False)
+
+    @classmethod
+    def _call_es(cls, es_instance, func, *args, **kwargs):
+        '''
+        Calls func, which sends a request via es_instance, through the circuit breaker of that client if
+        BUNGIESEARCH['CIRCUIT_BREAKER'] is defined. If BUNGIESEARCH['CONNECTION']['HEALTH_CHECK'] is set, the cluster is
+        pinged before the first request of the client, and requests fail fast while it is unhealthy.
+        :raise ClusterUnhealthy: If the cluster did not respond to the health check.
+        '''
+        connection = cls.BUNGIE.get('CONNECTION', {})
+        if connection.get('HEALTH_CHECK', False) and not registry.check_health(es_instance, backoff=connection.get('HEALTH_CHECK_BACKOFF', HEALTH_CHECK_BACKOFF)):
+            raise ClusterUnhealthy('N/A', 'Elasticsearch cluster did not respond to the health check.')
+
+        options = cls.BUNGIE.get('CIRCUIT_BREAKER')
+        if options is None:
+            return func(*args, **kwargs)
+        breaker = registry.get_breaker(es_instance, failures=options.get('FAILURES', 5), window=options.get('WINDOW', 30), reset_timeout=options.get('RESET_TIMEOUT', 30))
+        return breaker.call(func, *args, **kwargs)
+
+    def _fallback_queryset(self, exc):
+        '''
+        Returns the fallback queryset of the ModelIndex of this search, to be used because elasticsearch is unavailable.
+        :param exc: the exception raised by the elasticsearch client, which is raised again if there is no fallback.
+        '''
+        if self._raw_results_only or not is_unavailable(exc) or len(self._doc_type) != 1:
+            raise exc
+        try:
+            queryset = self.get_model_index(self._doc_type[0]).fallback_queryset(self)
+        except KeyError:
+            raise exc
+        if queryset is None:
+            raise exc
+        logger.warning('Elasticsearch is unavailable ({}): using the database fallback of {}.'.format(exc, self._doc_type[0]))
+        return queryset
+
+    def ping(self):
+        '''
+        Returns True if the elasticsearch cluster of this instance responds, False otherwise.
+        '''
+        return registry.ping(self.get_es_instance())
+
     def execute_raw(self):
-        self.raw_results = super(Bungiesearch, self).execute()
+        search = self._execution_search()
+        if self._cache_ttl is None:
+            self._response = self._call_es(search.get_es_instance(), super(Bungiesearch, search).execute)
+        else:
+            cache = get_search_cache()
+            cache_key = cache.build_key(search.to_dict(), self._index or list(self.get_indices()), self._doc_type, self._params)
+            cached_response = cache.get(cache_key)
+            if cached_response is not None:
+                self._response = Response(cached_response, callbacks=self._doc_type_map)
+            else:
+                self._response = self._call_es(search.get_es_instance(), super(Bungiesearch, search).execute)
+                # Must be stored before accessing the hits, which updates the underlying dictionary.
+                cache.set(cache_key, self._response._d_, self._cache_ttl or None)
+        self.raw_results = self._response
+        self._count = self.raw_results.hits.total
 
     def execute(self, return_results=True):
         '''
@@ -287,12 +607,17 @@ class Bungiesearch(Search):
         if self.results:
             return self.results if return_results else None
 
-        self.execute_raw()
-
-        if self._raw_results_only:
-            self.results = self.raw_results
+        try:
+            self.execute_raw()
+        except TransportError as e:
+            queryset = self._fallback_queryset(e)
+            start = self._extra.get('from', 0)
+            self.results = list(queryset[start:start + self._extra.get('size', 10)])
         else:
-            self.map_results()
+            if self._raw_results_only:
+                self.results = self.raw_results
+            else:
+                self.map_results()
 
         if return_results:
             return self.results
@@ -303,6 +628,118 @@ class Bungiesearch(Search):
         '''
         self.results = Bungiesearch.map_raw_results(self.raw_results, self)
 
+    def count(self):
+        '''
+        Returns the number of hits matching this search. Uses the total of an already executed search if available,
+        otherwise performs a count request. The result is cached on this instance.
+        '''
+        if self._count is None:
+            search = self._read_search()
+            try:
+                self._count = self._call_es(search.get_es_instance(), super(Bungiesearch, search).count)
+            except TransportError as e:
+                self._count = self._fallback_queryset(e).count()
+        return self._count
+
+    def execute_page(self, start, stop):
+        '''
+        Executes the [start:stop] slice of this search and returns a tuple of the results and the total number of hits.
+        Only one request is sent to elasticsearch, which makes this the preferred call for paginators.
+        :param start: offset of the first item of the page.
+        :param stop: offset following the last item of the page.
+        '''
+        page = super(Bungiesearch, self).__getitem__(slice(start, stop))
+        results = page.execute()
+        self._count = page._count
+        return results, self._count
+
+    def cache(self, ttl=0):
+        '''
+        Caches the raw response of this search, keyed by the search body, indices and doc types. Cached responses are
+        invalidated when the index is updated via Bungiesearch. Results are still mapped to the database.
+        :param ttl: time to live of the cached response in seconds. Set to 0 to use BUNGIESEARCH['CACHE']['TTL'], or to None to disable caching.
+        '''
+        s = self._clone()
+        s._cache_ttl = ttl
+        return s
+
+    def execute_after(self, cursor=None, size=10, tiebreaker=None):
+        '''
+        Executes the page of `size` items following the provided cursor, and returns a tuple of the results and of
+        the cursor of the next page (None if this is the last page). Contrary to slicing, the cost of a page does not
+        depend on its depth. The sort of this search is completed with the tiebreaker field in order to be stable.
+        Elasticsearch 2 does not support `search_after`, so the page is selected by filtering on the sort values of
+        the last item of the previous page: this search must not be sorted on `_score`.
+        :param cursor: opaque cursor as returned by the previous call, or None for the first page.
+        :param size: number of items per page.
+        :param tiebreaker: unique field used to break sort ties, defaults to `_uid` (which is unique across doc types).
+        :return: a tuple of the results and of the next cursor, which is None if the results come from the database
+        fallback of the ModelIndex, since these cannot be paginated with a cursor.
+        '''
+        sort = []
+        for key in self._sort:
+            if isinstance(key, dict):
+                field, order = list(key.items())[0]
+                if isinstance(order, dict):
+                    order = order.get('order', 'asc')
+            else:
+                field, order = key, 'asc'
+            if field == '_score':
+                raise ValueError('Cannot paginate with a cursor on a search sorted by _score.')
+            sort.append((field, order))
+
+        tiebreaker = tiebreaker or '_uid'
+        if tiebreaker not in [field for field, _ in sort]:
+            sort.append((tiebreaker, 'asc'))
+
+        s = self.sort(*[{field: {'order': order}} for field, order in sort])
+        if cursor:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            # Items after the cursor are those whose first differing sort value is after the cursor value.
+            clauses = []
+            for pos, (field, order) in enumerate(sort):
+                must = [Q('term', **{prev_field: values[prev_pos]}) for prev_pos, (prev_field, _) in enumerate(sort[:pos])]
+                must.append(Q('range', **{field: {'gt' if order == 'asc' else 'lt': values[pos]}}))
+                clauses.append(Q('bool', must=must))
+            s = s.filter(Q('bool', should=clauses, minimum_should_match=1))
+
+        s = s.extra(size=size)
+        s._extra.pop('from', None)
+        results = s.execute()
+        if s.raw_results is None:
+            logger.warning('Search after cursor {} used the database fallback: no further page is returned.'.format(cursor))
+            return results, None
+        hits = s.raw_results.hits
+        if len(hits) < size:
+            return results, None
+        next_cursor = base64.urlsafe_b64encode(json.dumps(list(hits[-1].meta.sort)).encode('utf-8')).decode('ascii')
+        return results, next_cursor
+
+    def aexecute(self, return_results=True, executor=None):
+        '''
+        Awaitable version of `execute`. The search and the result mapping are executed in an executor.
+        :param executor: concurrent.futures executor to use, defaults to the default executor of the event loop.
+        '''
+        return run_in_executor(lambda: self.execute(return_results), executor)
+
+    def acount(self, executor=None):
+        '''
+        Awaitable version of `count`, executed in an executor.
+        '''
+        return run_in_executor(self.count, executor)
+
+    def aiter(self, executor=None):
+        '''
+        Returns an asynchronous iterator over the results, executing the search in the provided executor.
+        '''
+        return AsyncResultsIterator(self, executor)
+
+    def __aiter__(self):
+        '''
+        Allows asynchronous iteration on the response (`async for item in search`).
+        '''
+        return self.aiter()
+
     def only(self, *fields):
         '''
         Restricts the fields to be fetched when mapping. Set to `__model` to fetch all fields define in the ModelIndex.
@@ -314,6 +751,43 @@ class Bungiesearch(Search):
             s._only = fields
         return s
 
+    def fetch_source(self, fetch=True):
+        '''
+        Requests `_source` from elasticsearch even though results are mapped to database objects, which by default only
+        requires the metadata of each hit. Useful to read the source of each hit from `raw_results`.
+        '''
+        s = self._clone()
+        s._fetch_source = fetch
+        return s
+
+    def select_related(self, *fields):
+        '''
+        Follows the provided foreign keys when mapping results to database objects, as Django's `select_related`.
+        Call without any field to follow all non null foreign keys, or with None to clear the list (and use the
+        ModelIndex defaults). Lookups which do not apply to a model of the search are ignored for that model.
+        '''
+        s = self._clone()
+        if fields == (None,):
+            s._select_related = []
+        elif not fields:
+            s._select_related = True
+        elif s._select_related is not True:
+            s._select_related.extend(fields)
+        return s
+
+    def prefetch_related(self, *lookups):
+        '''
+        Prefetches the provided related objects when mapping results to database objects, as Django's `prefetch_related`.
+        Call with None to clear the list (and use the ModelIndex defaults). Lookups which do not apply to a model of the
+        search are ignored for that model.
+        '''
+        s = self._clone()
+        if lookups == (None,):
+            s._prefetch_related = []
+        else:
+            s._prefetch_related.extend(lookups)
+        return s
+
     def __iter__(self):
         '''
         Allows iterating on the response.
@@ -323,7 +797,7 @@ class Bungiesearch(Search):
 
     def __len__(self):
         '''
-        Return elasticsearch-dsl-py count.
+        Returns the total number of hits, without sending a request if this search was already executed or counted.
         '''
         return self.count()
 
@@ -347,7 +821,10 @@ class Bungiesearch(Search):
                 single_item = False
         else:
             single_item = True
-        results = super(Bungiesearch, self).__getitem__(key).execute()
+        page = super(Bungiesearch, self).__getitem__(key)
+        results = page.execute()
+        if self._count is None:
+            self._count = page._count
         if single_item:
             try:
                 return results[0]
@@ -359,15 +836,15 @@ class Bungiesearch(Search):
         '''
         Returns the alias function, if it exists and if it can be applied to this model.
         '''
+        self._load_aliases()
         try:
             search_alias = self._alias_hooks[alias]
         except KeyError:
             raise AttributeError('Could not find search alias named {}. Is this alias defined in BUNGIESEARCH["ALIASES"]?'.format(alias))
         else:
-            if search_alias._applicable_models and \
-                ((model_obj and model_obj not in search_alias._applicable_models) or \
-                 not any([app_model_obj.__name__ in self._doc_type for app_model_obj in search_alias._applicable_models])):
-                    raise ValueError('Search alias {} is not applicable to model/doc_types {}.'.format(alias, model_obj if model_obj else self._doc_type))
+            applicable = self._alias_applicability.get(alias)
+            if applicable is not None and ((model_obj and model_obj not in applicable[0]) or applicable[1].isdisjoint(self._doc_type)):
+                raise ValueError('Search alias {} is not applicable to model/doc_types {}.'.format(alias, model_obj if model_obj else self._doc_type))
             return search_alias.prepare(self, model_obj).alias_for
 
     def __getattr__(self, alias):
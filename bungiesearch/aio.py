@@ -0,0 +1,94 @@
+'''
+Helpers to use Bungiesearch from asyncio code (Python 3.5+).
+
+The elasticsearch client and the Django ORM are both blocking, hence searches and result mapping are executed in an
+executor so that the event loop is never blocked. This module must not use the `async` syntax in order to remain
+importable on Python 2.
+'''
+from django.db import close_old_connections
+
+
+def _closing_connections(func):
+    '''
+    Wraps func so that the database connections opened by the executor thread are handled as at the end of a request.
+    '''
+    def wrapper():
+        try:
+            return func()
+        finally:
+            close_old_connections()
+    return wrapper
+
+
+def _get_running_loop():
+    import asyncio
+    # get_running_loop was added in Python 3.7, before which get_event_loop returns the running loop within coroutines.
+    return getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+
+
+class ExecutorAwaitable(object):
+    '''
+    Awaitable which calls func in the provided executor, or in the default executor of the running event loop. The loop
+    is only looked up when awaited, hence this may be created outside of a coroutine.
+    '''
+    def __init__(self, func, executor=None):
+        self.func = func
+        self.executor = executor
+
+    def __await__(self):
+        return _get_running_loop().run_in_executor(self.executor, _closing_connections(self.func)).__await__()
+
+
+class CompletedAwaitable(object):
+    '''
+    Awaitable which immediately returns result.
+    '''
+    def __init__(self, result):
+        self.result = result
+
+    def __await__(self):
+        future = _get_running_loop().create_future()
+        future.set_result(self.result)
+        return future.__await__()
+
+
+def run_in_executor(func, executor=None):
+    '''
+    Returns an awaitable which calls func in the provided executor, or in the default executor of the event loop.
+    '''
+    return ExecutorAwaitable(func, executor)
+
+
+def completed(result):
+    '''
+    Returns an awaitable which immediately returns result.
+    '''
+    return CompletedAwaitable(result)
+
+
+class AsyncResultsIterator(object):
+    '''
+    Asynchronous iterator over the results of a Bungiesearch instance. The search is executed on the first iteration.
+    '''
+    def __init__(self, search, executor=None):
+        self.search = search
+        self.executor = executor
+        self.results = None
+
+    def __aiter__(self):
+        return self
+
+    def _next(self):
+        try:
+            return next(self.results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    def _execute_and_next(self):
+        self.results = iter(self.search.execute())
+        return self._next()
+
+    def __anext__(self):
+        if self.results is None:
+            return run_in_executor(self._execute_and_next, self.executor)
+        return completed(self._next())
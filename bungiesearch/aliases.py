@@ -20,10 +20,9 @@ class SearchAlias(object):
         self.model = None
 
     def _clone(self):
-        s = self.__class__()
-        s._classname = self._classname
-        s._applicable_models = self._applicable_models
-        s.alias_name = self.alias_name
+        # Copying the attributes rather than instantiating the class, which would introspect Meta again.
+        s = self.__class__.__new__(self.__class__)
+        s.__dict__.update(self.__dict__)
         return s
 
     def prepare(self, search_instance, model_obj):
@@ -39,9 +38,23 @@ class SearchAlias(object):
         if self.model:
             return self.model
         if self.search_instance._doc_type and len(self.search_instance._doc_type) == 1:
-            idxes = self.search_instance._model_name_to_model_idx[self.search_instance._doc_type[0]]
+            idxes = self.search_instance.get_model_index(self.search_instance._doc_type[0], default=False)
             first_mdl = idxes[0].get_model()
             if all(mdlidx.get_model() == first_mdl for mdlidx in idxes[1:]):
                 return first_mdl
             raise ValueError('SearchAlias {} is associated to more than one index, and the model is differs between indices!')
         raise ValueError('Instance associated to zero doc types or more than one.')
+
+
+class SearchAliasAttribute(object):
+    '''
+    Class attribute giving access to a search alias from Bungiesearch instances, which is found by a plain attribute lookup
+    instead of only after the lookup failed and `__getattr__` was called.
+    '''
+    def __init__(self, alias):
+        self.alias = alias
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.hook_alias(self.alias)
@@ -0,0 +1,90 @@
+import time
+from collections import deque
+from threading import Lock
+
+from elasticsearch.exceptions import ConnectionError, TransportError
+
+
+class CircuitBreakerOpen(ConnectionError):
+    '''
+    Raised instead of sending a request to a cluster which recently failed too often.
+    '''
+    def __str__(self):
+        return 'CircuitBreakerOpen({})'.format(self.error)
+
+
+class ClusterUnhealthy(ConnectionError):
+    '''
+    Raised instead of sending a request to a cluster which did not respond to its health check.
+    '''
+    def __str__(self):
+        return 'ClusterUnhealthy({})'.format(self.error)
+
+
+def is_unavailable(exc):
+    '''
+    Returns True if the exception means that the cluster is unavailable (connection errors, timeouts and server errors).
+    '''
+    if isinstance(exc, ConnectionError):
+        return True
+    return isinstance(exc, TransportError) and isinstance(exc.status_code, int) and exc.status_code >= 500
+
+
+class CircuitBreaker(object):
+    '''
+    Fails fast once a cluster failed `failures` times within `window` seconds. After `reset_timeout` seconds, a single
+    trial request is let through: the breaker closes if it succeeds, and opens again otherwise.
+    '''
+    def __init__(self, failures=5, window=30, reset_timeout=30):
+        self.failures = failures
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self._lock = Lock()
+        self._failure_times = deque()
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def _before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._trial or time.time() - self._opened_at < self.reset_timeout:
+                raise CircuitBreakerOpen('N/A', 'Circuit breaker open after {} failures within {} seconds.'.format(self.failures, self.window))
+            self._trial = True
+
+    def _record_failure(self):
+        now = time.time()
+        with self._lock:
+            self._failure_times.append(now)
+            while self._failure_times and self._failure_times[0] < now - self.window:
+                self._failure_times.popleft()
+            if self._trial or len(self._failure_times) >= self.failures:
+                self._opened_at = now
+                self._failure_times.clear()
+            self._trial = False
+
+    def _record_success(self):
+        with self._lock:
+            self._opened_at = None
+            self._trial = False
+            self._failure_times.clear()
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Calls func unless the breaker is open, in which case CircuitBreakerOpen is raised.
+        '''
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_unavailable(e):
+                self._record_failure()
+            else:
+                self._record_success()
+            raise
+        self._record_success()
+        return result
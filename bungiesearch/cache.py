@@ -0,0 +1,179 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from importlib import import_module
+from threading import Lock
+
+from six import string_types
+
+from .logger import logger
+
+
+class SearchCache(object):
+    '''
+    Stores raw elasticsearch responses keyed by a stable hash of the search request.
+
+    Each index has a generation number which is part of the key of every search on that index. Invalidating an index
+    increments its generation, hence all cached responses of searches on that index are no longer reachable and expire.
+    Subclasses must implement `_get`, `_set`, `get_generation` and `invalidate`.
+    '''
+    key_prefix = 'bungiesearch'
+
+    def __init__(self, ttl=60, **kwargs):
+        self.ttl = ttl
+
+    def _get(self, key):
+        raise NotImplementedError('{} does not implement _get.'.format(self.__class__.__name__))
+
+    def _set(self, key, value, ttl):
+        raise NotImplementedError('{} does not implement _set.'.format(self.__class__.__name__))
+
+    def get_generation(self, index):
+        '''
+        Returns the current generation number of this index.
+        '''
+        raise NotImplementedError('{} does not implement get_generation.'.format(self.__class__.__name__))
+
+    def invalidate(self, index):
+        '''
+        Invalidates all cached responses of searches performed on this index.
+        '''
+        raise NotImplementedError('{} does not implement invalidate.'.format(self.__class__.__name__))
+
+    def build_key(self, body, index=None, doc_type=None, params=None):
+        '''
+        Returns the cache key of a search request.
+        :param body: search body, as returned by `to_dict()`.
+        :param index: list of index names the search is performed on.
+        :param doc_type: list of doc types the search is performed on.
+        :param params: additional query parameters.
+        '''
+        index = sorted(index or [])
+        request = json.dumps({'body': body, 'index': index, 'doc_type': sorted(doc_type or []), 'params': params or {}}, sort_keys=True, default=str)
+        generations = ','.join(str(self.get_generation(idx)) for idx in index)
+        return '{}:search:{}:{}'.format(self.key_prefix, hashlib.sha1(request.encode('utf-8')).hexdigest(), generations)
+
+    def get(self, key):
+        '''
+        Returns the raw response stored for this key, or None.
+        '''
+        value = self._get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, response, ttl=None):
+        '''
+        Stores a raw response (as a dictionary) for this key.
+        '''
+        self._set(key, json.dumps(response, default=str), ttl if ttl is not None else self.ttl)
+
+
+class LRUSearchCache(SearchCache):
+    '''
+    In-process least recently used cache. Invalidation only applies to the current process.
+    '''
+    def __init__(self, ttl=60, max_size=1000, **kwargs):
+        super(LRUSearchCache, self).__init__(ttl=ttl)
+        self.max_size = max_size
+        self._lock = Lock()
+        self._data = OrderedDict()
+        self._generations = {}
+
+    def _get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            # Re-inserting the key marks it as the most recently used.
+            self._data[key] = (expires, value)
+            return value
+
+    def _set(self, key, value, ttl):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl if ttl else None, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def get_generation(self, index):
+        return self._generations.get(index, 0)
+
+    def invalidate(self, index):
+        with self._lock:
+            self._generations[index] = self._generations.get(index, 0) + 1
+
+
+class DjangoSearchCache(SearchCache):
+    '''
+    Uses one of the caches defined in the Django CACHES setting, hence invalidation is shared between processes.
+    '''
+    def __init__(self, ttl=60, alias='default', **kwargs):
+        super(DjangoSearchCache, self).__init__(ttl=ttl)
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def _get(self, key):
+        return self.cache.get(key)
+
+    def _set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def _generation_key(self, index):
+        return '{}:gen:{}'.format(self.key_prefix, index)
+
+    def get_generation(self, index):
+        return self.cache.get(self._generation_key(index), 0)
+
+    def invalidate(self, index):
+        key = self._generation_key(index)
+        # The generation must outlive every cached response, hence it never expires.
+        if not self.cache.add(key, 1, None):
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                self.cache.set(key, 1, None)
+
+
+_search_cache = None
+_search_cache_lock = Lock()
+
+
+def get_search_cache():
+    '''
+    Returns the search cache defined in BUNGIESEARCH['CACHE']. Defaults to an in-process LRU cache.
+    '''
+    global _search_cache
+    if _search_cache is None:
+        from . import Bungiesearch
+        cache_settings = Bungiesearch.BUNGIE.get('CACHE', {})
+
+        with _search_cache_lock:
+            if _search_cache is None:
+                backend = cache_settings.get('BACKEND', 'lru')
+                if backend == 'lru':
+                    cache_class = LRUSearchCache
+                elif backend == 'django':
+                    cache_class = DjangoSearchCache
+                elif isinstance(backend, string_types):
+                    cache_path = backend.split('.')
+                    cache_class = getattr(import_module('.'.join(cache_path[:-1])), cache_path[-1])
+                else:
+                    cache_class = backend
+                _search_cache = cache_class(ttl=cache_settings.get('TTL', 60), max_size=cache_settings.get('MAX_SIZE', 1000), alias=cache_settings.get('ALIAS', 'default'))
+    return _search_cache
+
+
+def invalidate_search_cache(index):
+    '''
+    Invalidates the cached responses of the provided index, if the search cache is in use.
+    '''
+    from . import Bungiesearch
+    if _search_cache is None and 'CACHE' not in Bungiesearch.BUNGIE:
+        return # No search was cached by this process and no shared cache is configured.
+    logger.debug('Invalidating search cache for index {}.'.format(index))
+    get_search_cache().invalidate(index)
@@ -0,0 +1,101 @@
+import os
+import time
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+from elasticsearch.client import Elasticsearch
+
+from .breaker import CircuitBreaker
+from .logger import logger
+
+# Number of seconds during which a cluster which did not respond to a health check is not pinged again.
+HEALTH_CHECK_BACKOFF = 30
+
+
+class ConnectionRegistry(object):
+    '''
+    Thread safe registry of elasticsearch clients, keyed by their settings.
+
+    Clients (and their connection pools) must not be shared between a process and its forked children, hence the
+    registry empties itself in the child after a fork. This relies on `os.register_at_fork` where available (Python 3.7+)
+    and on a check of the process id otherwise.
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._clients = {}
+        self._health = WeakKeyDictionary()
+        self._breakers = WeakKeyDictionary()
+        self._pid = os.getpid()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        '''
+        Forgets all clients. The lock is also replaced since it may have been held by another thread during a fork.
+        '''
+        self._lock = Lock()
+        self._clients = {}
+        self._health = WeakKeyDictionary()
+        self._breakers = WeakKeyDictionary()
+        self._pid = os.getpid()
+
+    def get(self, key, urls, timeout, force_new=False, **settings):
+        '''
+        Returns the client registered for this key, creating it if needed.
+        :param key: hashable key identifying the client settings.
+        :param urls: list of URLs, or string of a single URL, passed to the client.
+        :param timeout: timeout of the client.
+        :param force_new: set to True to create a new client, which replaces any client registered for this key.
+        :param settings: additional settings passed to the client.
+        '''
+        if self._pid != os.getpid():
+            self.reset()
+
+        with self._lock:
+            client = None if force_new else self._clients.get(key)
+            if client is None:
+                client = Elasticsearch(urls, timeout=timeout, **settings)
+                self._clients[key] = client
+        return client
+
+    def ping(self, client):
+        '''
+        Returns True if the cluster of this client responds, False otherwise.
+        '''
+        try:
+            return bool(client.ping())
+        except Exception as e:
+            logger.warning('Could not ping elasticsearch: {}.'.format(e))
+            return False
+
+    def check_health(self, client, backoff=HEALTH_CHECK_BACKOFF):
+        '''
+        Pings the cluster of this client the first time it is used in this process. Subsequent calls are free until the
+        next fork. If the ping failed, the cluster is reported unhealthy without being pinged again for `backoff` seconds.
+        :return: True if the cluster responded (now or previously), False otherwise.
+        '''
+        health = self._health.get(client)
+        if health is True:
+            return True
+        if health is not None and health > time.time():
+            return False
+
+        healthy = self.ping(client)
+        with self._lock:
+            self._health[client] = True if healthy else time.time() + backoff
+        if not healthy:
+            logger.warning('Elasticsearch cluster at {} did not respond to ping, not pinging it again for {} seconds.'.format(client.transport.hosts, backoff))
+        return healthy
+
+    def get_breaker(self, client, **options):
+        '''
+        Returns the circuit breaker of this client, creating it with the provided options if needed.
+        '''
+        with self._lock:
+            breaker = self._breakers.get(client)
+            if breaker is None:
+                breaker = self._breakers[client] = CircuitBreaker(**options)
+        return breaker
+
+
+registry = ConnectionRegistry()
@@ -10,7 +10,8 @@ class AbstractField(object):
     Represents an elasticsearch index field and values from given objects.
     Currently does not support binary fields, but those can be created by manually providing a dictionary.
 
-    Values are extracted using the `model_attr` or `eval_as` attribute.
+    Values are extracted using the `model_attr` or `eval_as` attribute. Fields computed by `eval_as` or `template` may list
+    the model attributes they depend on in `depends_on`, which allows partial updates of the document.
     '''
     meta_fields = ['_index', '_uid', '_type', '_id']
     common_fields = ['index_name', 'store', 'index', 'boost', 'null_value', 'copy_to', 'type', 'fields']
@@ -54,6 +55,7 @@ class AbstractField(object):
         self.model_attr = args.pop('model_attr', None)
         self.eval_func = args.pop('eval_as', None)
         self.template_name = args.pop('template', None)
+        self.depends_on = args.pop('depends_on', None)
 
         for attr, value in iteritems(args):
             if attr not in self.fields and attr not in AbstractField.common_fields:
@@ -96,7 +98,7 @@ class AbstractField(object):
     def json(self):
         json = {}
         for attr, val in iteritems(self.__dict__):
-            if attr in ('eval_func', 'model_attr', 'template_name'):
+            if attr in ('eval_func', 'model_attr', 'template_name', 'depends_on'):
                 continue
             elif attr in ('analyzer', 'index_analyzer', 'search_analyzer') and isinstance(val, Analyzer):
                 json[attr] = val.to_dict()
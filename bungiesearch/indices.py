@@ -1,3 +1,8 @@
+import hashlib
+import json
+import time
+
+from django.core.exceptions import FieldDoesNotExist
 from six import iteritems, text_type
 
 from elasticsearch_dsl.analysis import Analyzer
@@ -18,7 +23,7 @@ class ModelIndex(object):
     1. Create a class which inherits from ModelIndex.
     2. Define custom indexed fields as class attributes. Values must be instances AbstractField. Important info in 3b.
     3. Define a `Meta` subclass, which must contain at least `model` as a class attribute.
-        a. Optional class attributes: `fields`, `excludes` and `additional_fields`.
+        a. Optional class attributes: `fields`, `excludes`, `additional_fields` and `dependencies`.
         b. If custom indexed field requires model attributes which are not in the difference between `fields` and `excludes`, these must be defined in `additional_fields`.
     '''
     def __init__(self):
@@ -36,11 +41,15 @@ class ModelIndex(object):
         excludes = getattr(_meta, 'exclude', [])
         hotfixes = getattr(_meta, 'hotfixes', {})
         additional_fields = getattr(_meta, 'additional_fields', [])
-        id_field = getattr(_meta, 'id_field', 'id')
+        self.id_field = id_field = getattr(_meta, 'id_field', 'id')
         self.updated_field = getattr(_meta, 'updated_field', None)
         self.optimize_queries = getattr(_meta, 'optimize_queries', False)
         self.is_default = getattr(_meta, 'default', True)
         self.indexing_query = getattr(_meta, 'indexing_query', None)
+        self.select_related = getattr(_meta, 'select_related', [])
+        self.prefetch_related = getattr(_meta, 'prefetch_related', [])
+        self.dependencies = getattr(_meta, 'dependencies', {})
+        self._mappings, self._analysis, self._fingerprint, self._field_dependencies = {}, None, None, None
 
         # Add in fields from the model.
         self.fields.update(self._get_fields(fields, excludes, hotfixes))
@@ -65,22 +74,38 @@ class ModelIndex(object):
         '''
         return True
 
+    def fallback_queryset(self, search):
+        '''
+        Returns None by default, meaning that searches fail if elasticsearch is unavailable.
+        Override to return a queryset of the model which is used instead of the search results when elasticsearch is
+        unavailable (e.g. timeouts, or circuit breaker open).
+
+        :param search: Bungiesearch instance which could not be executed.
+        '''
+        return None
+
     def get_model(self):
         return self.model
 
     def get_mapping(self, meta_fields=True):
         '''
-        Returns the mapping for the index as a dictionary.
+        Returns the mapping for the index as a dictionary. The mapping is only computed once, hence it must not be modified.
 
         :param meta_fields: Also include elasticsearch meta fields in the dictionary.
         :return: a dictionary which can be used to generate the elasticsearch index mapping for this doctype.
         '''
-        return {'properties': dict((name, field.json()) for name, field in iteritems(self.fields) if meta_fields or name not in AbstractField.meta_fields)}
+        if meta_fields not in self._mappings:
+            self._mappings[meta_fields] = {'properties': dict((name, field.json()) for name, field in iteritems(self.fields) if meta_fields or name not in AbstractField.meta_fields)}
+        return self._mappings[meta_fields]
 
     def collect_analysis(self):
         '''
+        The analysis is only computed once, hence it must not be modified.
         :return: a dictionary which is used to get the serialized analyzer definition from the analyzer class.
         '''
+        if self._analysis is not None:
+            return self._analysis
+
         analysis = {}
         for field in self.fields.values():
             for analyzer_name in ('analyzer', 'index_analyzer', 'search_analyzer'):
@@ -99,14 +124,62 @@ class ModelIndex(object):
                 for key in definition:
                     analysis.setdefault(key, {}).update(definition[key])
 
+        self._analysis = analysis
         return analysis
 
-    def serialize_object(self, obj, obj_pk=None):
+    def get_fingerprint(self):
+        '''
+        Returns a hash of the mapping and analysis of this doctype, which changes whenever either of them changes.
+        '''
+        if self._fingerprint is None:
+            definition = json.dumps({'mapping': self.get_mapping(meta_fields=False), 'analysis': self.collect_analysis()}, sort_keys=True, default=text_type)
+            self._fingerprint = hashlib.sha1(definition.encode('utf-8')).hexdigest()
+        return self._fingerprint
+
+    def get_dependent_fields(self, update_fields):
+        '''
+        Returns the names of the index fields whose value depends on the provided model attributes.
+
+        :param update_fields: names or attnames (e.g. `author_id`) of the updated model attributes, e.g. as passed to `save`.
+        :return: a set of field names, or None if unknown because the value of a field is computed (by `eval_as`, a
+        template, a `prepare_` method or a model method) and its dependencies are not declared (via its `depends_on`
+        parameter or `Meta.dependencies`).
+        '''
+        if self._field_dependencies is None:
+            model_fields = set(f.name for f in self.model._meta.fields)
+            self._field_dependencies = {}
+            for name, field in iteritems(self.fields):
+                if name == '_id':
+                    continue # The document id is never updated.
+                depends_on = self.dependencies.get(name, field.depends_on)
+                if depends_on is None and not (field.eval_func or field.template_name or hasattr(self, 'prepare_%s' % name)) and field.model_attr in model_fields:
+                    depends_on = [field.model_attr]
+                self._field_dependencies[name] = set(depends_on) if depends_on is not None else None
+
+        # Saves of deferred instances, for one, pass the attname of foreign keys.
+        update_fields = set(self._get_field_name(name) for name in update_fields)
+        dependent_fields = set()
+        for name, depends_on in iteritems(self._field_dependencies):
+            if depends_on is None:
+                return None
+            if depends_on.intersection(update_fields):
+                dependent_fields.add(name)
+        return dependent_fields
+
+    def _get_field_name(self, name):
+        try:
+            return self.model._meta.get_field(name).name
+        except FieldDoesNotExist:
+            return name
+
+    def serialize_object(self, obj, obj_pk=None, fields=None, timings=None):
         '''
         Serializes an object for it to be added to the index.
 
         :param obj: Object to be serialized. Optional if obj_pk is passed.
         :param obj_pk: Object primary key. Superseded by `obj` if available.
+        :param fields: names of the fields to serialize, defaults to all the fields.
+        :param timings: optional dictionary to which the time spent computing each field is added, keyed by field name.
         :return: A dictionary representing the object as defined in the mapping.
         '''
         if not obj:
@@ -119,12 +192,18 @@ class ModelIndex(object):
         serialized_object = {}
 
         for name, field in iteritems(self.fields):
+            if fields is not None and name not in fields:
+                continue
+            if timings is not None:
+                start = time.time()
             if hasattr(self, "prepare_%s" % name):
                 value = getattr(self, "prepare_%s" % name)(obj)
             else:
                 value = field.value(obj)
 
             serialized_object[name] = value
+            if timings is not None:
+                timings[name] = timings.get(name, 0) + time.time() - start
 
         return serialized_object
 
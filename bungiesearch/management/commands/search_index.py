@@ -1,11 +1,16 @@
+import json
 from collections import defaultdict
 
 from django.core.management.base import BaseCommand
-from six import iteritems
+from six import iteritems, itervalues
 
 from ... import Bungiesearch
 from ...logger import logger
-from ...utils import update_index
+from ...progress import IndexingProgress
+from ...reindex import reindex_from_source
+from ...snapshot import export_index, import_index
+from ...utils import (FINGERPRINT_META_KEY, IndexingCheckpoints, diff_analysis, diff_mapping, drain_outbox, get_index_body,
+                       get_live_fingerprint, update_index, update_index_windows)
 
 
 class Command(BaseCommand):
@@ -31,7 +36,39 @@ class Command(BaseCommand):
             action='store_const',
             dest='action',
             const='update-mapping',
-            help='Update the mapping of specified models (or all models) on the index specified in the settings.')
+            help='Add the missing fields of specified models (or all models) to the mapping of the index specified in the settings. Fails if a change cannot be applied in place, unless --reindex-on-conflict is set.')
+        parser.add_argument(
+            '--check',
+            action='store_const',
+            dest='action',
+            const='check',
+            help='Check that the mapping of each model on the index specified in the settings matches the search indices, by comparing their fingerprints.')
+        parser.add_argument(
+            '--reindex-from-source',
+            action='store_const',
+            dest='action',
+            const='reindex-from-source',
+            help='Rebuild the index specified in the settings with the current mappings and analysis, copying its documents from their source instead of the database, then swap it in behind an alias.')
+        parser.add_argument(
+            '--drain-outbox',
+            action='store_const',
+            dest='action',
+            const='drain-outbox',
+            help='Send the operations recorded in the indexing outbox (cf. OutboxSignalProcessor) to elasticsearch, in batches of --bulk-size rows.')
+        parser.add_argument(
+            '--export',
+            action='store',
+            dest='export_path',
+            default=None,
+            type=str,
+            help='Export the documents of the index specified with --index, and the mappings of its models, to a gzip compressed snapshot file.')
+        parser.add_argument(
+            '--import',
+            action='store',
+            dest='import_path',
+            default=None,
+            type=str,
+            help='Import a snapshot file written by --export into the index specified with --index (defaults to the exported index), creating it if needed.')
         parser.add_argument(
             '--delete',
             action='store_const',
@@ -44,6 +81,12 @@ class Command(BaseCommand):
             dest='action',
             const='delete-mapping',
             help='Delete the mapping of specified models (or all models) on the index specified in the settings. Requires the "--guilty-as-charged" flag.')
+        parser.add_argument(
+            '--reindex-on-conflict',
+            action='store_true',
+            dest='reindex_on_conflict',
+            default=False,
+            help='With --update-mapping, rebuild the indices whose mapping or analysis cannot be updated in place from source (as with --reindex-from-source).')
         parser.add_argument(
             '--guilty-as-charged',
             action='store_true',
@@ -90,6 +133,54 @@ class Command(BaseCommand):
             default=None,
             type=str,
             help='Specify the end date and time of documents to be indexed.')
+        parser.add_argument(
+            '--windows',
+            action='store',
+            dest='windows',
+            default=1,
+            type=int,
+            help='Specify the number of windows into which the period between --start and --end is split, each indexed concurrently. Only applies to models with an updated field.')
+        parser.add_argument(
+            '--split-by',
+            action='store',
+            dest='split_by',
+            default='time',
+            choices=['time', 'rows'],
+            help='Split the period into windows of equal duration ("time", default) or with about the same number of items ("rows").')
+        parser.add_argument(
+            '--checkpoint',
+            action='store',
+            dest='checkpoint',
+            default=None,
+            type=str,
+            help='Specify a file in which the progress of each window is stored, so that an interrupted run with the same windows resumes where it stopped. The limits of the windows are stored as well.')
+        parser.add_argument(
+            '--stats-json',
+            action='store',
+            dest='stats_json',
+            default=None,
+            type=str,
+            help='Specify a file to which the indexing statistics of each model are written as JSON ("-" for the standard output, in which case the summary is written to the standard error).')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='With --update, fetch and serialize the items without sending them to elasticsearch, and report the time spent on each field.')
+        parser.add_argument(
+            '--dry-run-output',
+            action='store',
+            dest='dry_run_output',
+            default=None,
+            type=str,
+            help='Specify a file to which the bulk actions of a dry run are written. By default they are discarded.')
+        parser.add_argument(
+            '--threads',
+            action='store',
+            dest='threads',
+            default=4,
+            type=int,
+            help='Specify the number of concurrent requests used to import a snapshot, or to copy the doctypes of an index with --reindex-from-source.')
         parser.add_argument(
             '--timeout',
             action='store',
@@ -100,10 +191,18 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         src = Bungiesearch(timeout=options.get('timeout'))
-        es = src.get_es_instance()
+
+        def get_es(index=None):
+            # Index management is performed on the write URLs.
+            return src.get_write_es_instance(index, timeout=options.get('timeout'))
+
+        if options.get('export_path'):
+            options['action'] = 'export'
+        elif options.get('import_path'):
+            options['action'] = 'import'
 
         if not options['action']:
-            raise ValueError('No action specified. Must be one of "create", "update" or "delete".')
+            raise ValueError('No action specified. Must be one of "create", "update", "check", "reindex-from-source", "export", "import" or "delete".')
 
         if options['action'].startswith('delete'):
             if not options['confirmed']:
@@ -116,7 +215,7 @@ class Command(BaseCommand):
 
                 for index in indices:
                     logger.warning('Deleting elastic search index {}.'.format(index))
-                    es.indices.delete(index=index, ignore=404)
+                    get_es(index).indices.delete(index=index, ignore=404)
 
             else:
                 index_to_doctypes = defaultdict(list)
@@ -135,7 +234,7 @@ class Command(BaseCommand):
                     logger.info('Deleting mapping for all models ({}) on all indices ({}).'.format(index_to_doctypes.values(), index_to_doctypes.keys()))
 
                 for index, doctype_list in iteritems(index_to_doctypes):
-                    es.indices.delete_mapping(index, ','.join(doctype_list), params=None)
+                    get_es(index).indices.delete_mapping(index, ','.join(doctype_list), params=None)
 
         elif options['action'] == 'create':
             if options['index']:
@@ -143,22 +242,11 @@ class Command(BaseCommand):
             else:
                 indices = src.get_indices()
             for index in indices:
-                mapping = {}
-                analysis = {'analyzer': {}, 'tokenizer': {}, 'filter': {}}
-
-                for mdl_idx in src.get_model_indices(index):
-                    mapping[mdl_idx.get_model().__name__] = mdl_idx.get_mapping(meta_fields=False)
-
-                    mdl_analysis = mdl_idx.collect_analysis()
-                    for key in analysis.keys():
-                        value = mdl_analysis.get(key)
-                        if value is not None:
-                            analysis[key].update(value)
-
-                logger.info('Creating index {} with {} doctypes.'.format(index, len(mapping)))
-                es.indices.create(index=index, body={'mappings': mapping, 'settings': {'analysis': analysis}})
+                body = get_index_body(index)
+                logger.info('Creating index {} with {} doctypes.'.format(index, len(body['mappings'])))
+                get_es(index).indices.create(index=index, body=body)
 
-            es.cluster.health(index=','.join(indices), wait_for_status='green', timeout='30s')
+            get_es().cluster.health(index=','.join(indices), wait_for_status='green', timeout='30s')
 
         elif options['action'] == 'update-mapping':
             if options['index']:
@@ -171,22 +259,94 @@ class Command(BaseCommand):
             else:
                 models = []
 
+            # Computing all the changes first, so that nothing is applied if any of them is incompatible.
+            index_changes, index_conflicts = defaultdict(dict), defaultdict(list)
             for index in indices:
-                for model_name in src._idx_name_to_mdl_to_mdlidx[index]:
+                live_index = next(itervalues(get_es(index).indices.get(index=index, feature='_mappings,_settings')))
+                analysis = {}
+                for mdl_idx in src.get_model_indices(index):
+                    model_name = mdl_idx.get_model().__name__
                     if models and model_name not in models:
                         continue
-                    logger.info('Updating mapping of model/doctype {} on index {}.'.format(model_name, index))
-                    try:
-                        es.indices.put_mapping(model_name, src._idx_name_to_mdl_to_mdlidx[index][model_name].get_mapping(), index=index)
-                    except Exception as e:
-                        print(e)
-                        if raw_input('Something terrible happened! Type "abort" to stop updating the mappings: ') == 'abort':
-                            raise e
-                        print('Continuing.')
+                    additions, conflicts = diff_mapping(live_index['mappings'].get(model_name, {}), mdl_idx.get_mapping(meta_fields=False))
+                    index_conflicts[index].extend('{}.{}'.format(model_name, conflict) for conflict in conflicts)
+                    if additions or get_live_fingerprint(live_index, model_name) != mdl_idx.get_fingerprint():
+                        index_changes[index][model_name] = dict(additions or {}, _meta={FINGERPRINT_META_KEY: mdl_idx.get_fingerprint()})
+                    for key, definitions in iteritems(mdl_idx.collect_analysis()):
+                        analysis.setdefault(key, {}).update(definitions)
+                index_conflicts[index].extend(diff_analysis(live_index['settings']['index'].get('analysis', {}), analysis))
+
+            conflicting = [index for index in indices if index_conflicts[index]]
+            for index in conflicting:
+                logger.warning('Mapping of index {} cannot be updated in place: {}.'.format(index, '; '.join(index_conflicts[index])))
+            if conflicting and not options.get('reindex_on_conflict'):
+                raise ValueError('Incompatible mapping changes on indices {}: run with --reindex-on-conflict to rebuild them from source.'.format(', '.join(conflicting)))
+
+            for index in indices:
+                if index in conflicting:
+                    reindex_from_source(index, thread_count=options['threads'], bulk_size=options['bulk_size'], timeout=options.get('timeout'))
+                    continue
+                for model_name, mapping in iteritems(index_changes[index]):
+                    logger.info('Updating mapping of model/doctype {} on index {}, adding fields {}.'.format(model_name, index, sorted(mapping.get('properties', {}).keys())))
+                    get_es(index).indices.put_mapping(model_name, mapping, index=index)
+
+        elif options['action'] == 'export':
+            if not options['index']:
+                raise ValueError('Specify the index to export with --index.')
+            export_index(options['index'], options['export_path'], bulk_size=options['bulk_size'], timeout=options.get('timeout'))
+
+        elif options['action'] == 'import':
+            import_index(options['import_path'], index_name=options['index'], bulk_size=options['bulk_size'], thread_count=options['threads'], timeout=options.get('timeout'))
+
+        elif options['action'] == 'reindex-from-source':
+            if options['index']:
+                indices = [options['index']]
+            else:
+                indices = src.get_indices()
+            for index in indices:
+                reindex_from_source(index, thread_count=options['threads'], bulk_size=options['bulk_size'], timeout=options.get('timeout'))
+
+        elif options['action'] == 'drain-outbox':
+            processed = drain_outbox(batch_size=options['bulk_size'])
+            logger.info('Drained {} outbox rows.'.format(processed))
+
+        elif options['action'] == 'check':
+            if options['index']:
+                indices = [options['index']]
+            else:
+                indices = src.get_indices()
+
+            # Fetching the live mappings of all the indices stored on the same cluster in one request. Their aliases are
+            # fetched as well, since indices rebuilt with --reindex-from-source are only known by an alias.
+            cluster_indices = defaultdict(list)
+            for index in indices:
+                cluster_indices[get_es(index)].append(index)
+            live_mappings = {}
+            for es, es_indices in iteritems(cluster_indices):
+                for name, live_index in iteritems(es.indices.get(index=','.join(es_indices), feature='_mappings,_aliases', ignore_unavailable=True)):
+                    live_mappings[name] = live_index
+                    for alias in live_index.get('aliases', {}):
+                        live_mappings[alias] = live_index
+
+            out_of_sync = []
+            for index in indices:
+                if index not in live_mappings:
+                    logger.warning('Index {} does not exist.'.format(index))
+                    out_of_sync.append(index)
+                    continue
+                for mdl_idx in src.get_model_indices(index):
+                    model_name = mdl_idx.get_model().__name__
+                    if get_live_fingerprint(live_mappings[index], model_name) != mdl_idx.get_fingerprint():
+                        logger.warning('Mapping of model/doctype {} on index {} does not match its search index.'.format(model_name, index))
+                        out_of_sync.append('{}/{}'.format(index, model_name))
+
+            if out_of_sync:
+                raise ValueError('Mappings are out of sync for {}: run with --update-mapping, or rebuild the index.'.format(', '.join(out_of_sync)))
+            logger.info('Mappings of indices {} are in sync.'.format(indices))
 
         else:
             if options['index']:
-                indices = options['index']
+                indices = [options['index']]
             else:
                 indices = src.get_indices()
             if options['models']:
@@ -196,9 +356,40 @@ class Command(BaseCommand):
 
             logger.info('Updating models {} on indices {}.'.format(model_names, indices))
 
+            if options.get('windows', 1) > 1 and options.get('num_docs', -1) != -1:
+                raise ValueError('--num-docs cannot be combined with --windows, which index the whole period of each window.')
+
+            dry_run = options.get('dry_run', False)
+            if dry_run:
+                logger.info('Dry run: documents will not be sent to elasticsearch.')
+            dry_run_output = open(options['dry_run_output'], 'w') if dry_run and options.get('dry_run_output') else None
+
             # Update index.
-            for model_name in model_names:
-                if src.get_model_index(model_name).indexing_query is not None:
-                    update_index(src.get_model_index(model_name).indexing_query, model_name, bulk_size=options['bulk_size'], num_docs=options['num_docs'], start_date=options['start_date'], end_date=options['end_date'])
+            progress = IndexingProgress()
+            checkpoints = IndexingCheckpoints(options.get('checkpoint'))
+            try:
+                for model_name in model_names:
+                    if src.get_model_index(model_name).indexing_query is not None:
+                        model_items = src.get_model_index(model_name).indexing_query
+                    else:
+                        model_items = src.get_model_index(model_name).get_model().objects.all()
+                    if options.get('windows', 1) > 1 and src.get_model_index(model_name).updated_field is not None:
+                        update_index_windows(model_items, model_name, start_date=options['start_date'], end_date=options['end_date'], windows=options['windows'], split_by=options.get('split_by', 'time'), bulk_size=options['bulk_size'], progress=progress, checkpoints=checkpoints, dry_run=dry_run, dry_run_output=dry_run_output)
+                    else:
+                        update_index(model_items, model_name, bulk_size=options['bulk_size'], num_docs=options['num_docs'], start_date=options['start_date'], end_date=options['end_date'], progress=progress, dry_run=dry_run, dry_run_output=dry_run_output)
+            finally:
+                if dry_run_output is not None:
+                    dry_run_output.close()
+
+            if options.get('stats_json') == '-':
+                # The standard output only holds the JSON statistics, so that they can be parsed.
+                self.stderr.write(progress.format_summary())
+            else:
+                self.stdout.write(progress.format_summary())
+            if options.get('stats_json'):
+                stats = json.dumps(progress.summary(), indent=2)
+                if options['stats_json'] == '-':
+                    self.stdout.write(stats)
                 else:
-                    update_index(src.get_model_index(model_name).get_model().objects.all(), model_name, bulk_size=options['bulk_size'], num_docs=options['num_docs'], start_date=options['start_date'], end_date=options['end_date'])
+                    with open(options['stats_json'], 'w') as stats_file:
+                        stats_file.write(stats)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from ... import Bungiesearch
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Loads all the indices and aliases defined in the settings and reports the time spent importing and instantiating each of them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit',
+            action='store',
+            dest='limit',
+            default=None,
+            type=int,
+            help='Specify the number of slowest items to report. By default will report all of them.')
+
+    def handle(self, *args, **options):
+        Bungiesearch.__load_settings__()
+        for index in Bungiesearch.get_indices():
+            Bungiesearch.get_model_indices(index)
+        timings = sorted(Bungiesearch._load_timings, key=lambda timing: timing[2], reverse=True)
+
+        self.stdout.write('{:<12} {:<60} {:>10}'.format('Kind', 'Name', 'Time (ms)'))
+        for kind, name, seconds in timings[:options['limit']]:
+            self.stdout.write('{:<12} {:<60} {:>10.1f}'.format(kind, name, seconds * 1000))
+        self.stdout.write('Loaded {} indices in {:.1f} ms.'.format(len(Bungiesearch._loaded_indices), sum(timing[2] for timing in timings) * 1000))
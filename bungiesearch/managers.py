@@ -1,10 +1,64 @@
 from django.conf import settings as dj_settings
+from django.core.exceptions import FieldDoesNotExist
 from django.db.models import Manager
+from django.db.models.query import QuerySet
 
 from .logger import logger
 
 
-class BungiesearchManager(Manager):
+class BungiesearchQuerySet(QuerySet):
+    '''
+    QuerySet whose bulk operations, which do not send the save signals, also update the index. Objects are fetched and
+    indexed with one query and one bulk request per chunk of `bulk_size` objects.
+    '''
+    def bulk_create_indexed(self, objs, batch_size=None, bulk_size=100):
+        '''
+        Same as `bulk_create`, and indexes the created objects. Only objects whose primary key is set by the database
+        (e.g. on PostgreSQL) or by the caller can be indexed.
+        '''
+        from .utils import update_index_by_pk
+        objs = self.bulk_create(objs, batch_size=batch_size)
+        pks = [obj.pk for obj in objs if obj.pk is not None]
+        if len(pks) < len(objs):
+            logger.warning('Could not index {} created {} objects: their primary keys are not returned by the database.'.format(len(objs) - len(pks), self.model.__name__))
+        update_index_by_pk(self.model, pks, bulk_size=bulk_size)
+        return objs
+
+    def update_indexed(self, bulk_size=100, **kwargs):
+        '''
+        Same as `update`, and indexes the updated objects.
+        '''
+        from .utils import update_index_by_pk
+        pks = list(self.values_list('pk', flat=True))
+        rows = self.update(**kwargs)
+        update_index_by_pk(self.model, pks, bulk_size=bulk_size)
+        return rows
+
+    def delete_indexed(self, bulk_size=100):
+        '''
+        Same as `delete`, and deletes the objects from the index in bulk instead of one by one.
+        '''
+        from . import Bungiesearch
+        from .signals import muted_deletes
+        from .utils import update_index
+
+        id_field = Bungiesearch.get_model_index(self.model.__name__).fields['_id']
+        try:
+            if id_field.eval_func or id_field.template_name:
+                raise FieldDoesNotExist()
+            self.model._meta.get_field(id_field.model_attr)
+            document_ids = list(self.values_list(id_field.model_attr, flat=True))
+        except FieldDoesNotExist:
+            document_ids = [id_field.value(obj) for obj in self]
+
+        with muted_deletes(self.model):
+            deleted = self.delete()
+        if document_ids:
+            update_index(document_ids, self.model.__name__, action='delete', bulk_size=bulk_size)
+        return deleted
+
+
+class BungiesearchManager(Manager.from_queryset(BungiesearchQuerySet)):
     model = None
 
     '''
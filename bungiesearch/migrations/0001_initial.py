@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexingOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_label', models.CharField(max_length=255)),
+                ('object_pk', models.CharField(max_length=255)),
+                ('document_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('action', models.CharField(choices=[('index', 'index'), ('delete', 'delete')], max_length=6)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
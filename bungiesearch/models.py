@@ -0,0 +1,19 @@
+from django.db import models
+
+
+class IndexingOutbox(models.Model):
+    '''
+    Indexing operation recorded by OutboxSignalProcessor, in the transaction of the delete or of the atomic block of the
+    save which caused it, and sent to elasticsearch by `search_index --drain-outbox`.
+    '''
+    ACTIONS = (('index', 'index'), ('delete', 'delete'))
+
+    model_label = models.CharField(max_length=255)
+    object_pk = models.CharField(max_length=255)
+    # Document id of deleted objects, which may differ from their primary key.
+    document_id = models.CharField(max_length=255, null=True, blank=True)
+    action = models.CharField(max_length=6, choices=ACTIONS)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{} {} {}'.format(self.action, self.model_label, self.object_pk)
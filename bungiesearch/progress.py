@@ -0,0 +1,83 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from .logger import logger
+
+
+class IndexingProgress(object):
+    '''
+    Collects the statistics of `update_index` per model, and logs the progress, throughput and ETA after each bulk request.
+
+    Time is split between fetching the items from the database (`db`), serializing them (`serialize`) and sending them to
+    elasticsearch (`network`). Sizes are those of the serialized documents, in bytes. For dry runs, the time spent
+    computing each field is also recorded (`fields`). Progress may be updated from several threads.
+    '''
+    phases = ('db', 'serialize', 'network')
+
+    def __init__(self):
+        self.started = time.time()
+        self.models = OrderedDict()
+        self._lock = Lock()
+
+    def _get_stats(self, model_name):
+        if model_name not in self.models:
+            self.models[model_name] = dict(indices=[], total=0, docs=0, bytes=0, errors=0, fields={}, started=time.time(), elapsed=0, **dict((phase, 0) for phase in self.phases))
+        return self.models[model_name]
+
+    def start(self, model_name, index_name, total):
+        '''
+        Records that `total` items of this model are about to be sent to this index.
+        '''
+        with self._lock:
+            stats = self._get_stats(model_name)
+            stats['indices'].append(index_name)
+            stats['total'] += total
+
+    def update(self, model_name, docs, size, errors, fields=None, **timings):
+        '''
+        Records a bulk request of `docs` documents totalling `size` bytes, and the time spent in each phase and computing
+        each field (if provided), then logs the progress of this model.
+        '''
+        with self._lock:
+            stats = self._get_stats(model_name)
+            stats['docs'] += docs
+            stats['bytes'] += size
+            stats['errors'] += errors
+            for phase in self.phases:
+                stats[phase] += timings.get(phase, 0)
+            for name, seconds in (fields or {}).items():
+                stats['fields'][name] = stats['fields'].get(name, 0) + seconds
+            stats['elapsed'] = time.time() - stats['started']
+
+        rate = stats['docs'] / stats['elapsed'] if stats['elapsed'] else 0
+        eta = (stats['total'] - stats['docs']) / rate if rate else 0
+        logger.info('{}: {} of {} documents, {:.0f} docs/s, {:.1f} KB/s, ETA {:.0f}s.'.format(model_name, stats['docs'], stats['total'], rate, stats['bytes'] / 1024.0 / stats['elapsed'] if stats['elapsed'] else 0, max(eta, 0)))
+
+    def summary(self):
+        '''
+        Returns the statistics of each model as a dictionary, with their throughput.
+        '''
+        summary = OrderedDict()
+        for model_name, stats in self.models.items():
+            summary[model_name] = dict((key, value) for key, value in stats.items() if key != 'started')
+            summary[model_name]['docs_per_second'] = stats['docs'] / stats['elapsed'] if stats['elapsed'] else 0
+            summary[model_name]['bytes_per_second'] = stats['bytes'] / stats['elapsed'] if stats['elapsed'] else 0
+        return summary
+
+    def format_summary(self):
+        '''
+        Returns the summary as a table, one line per model.
+        '''
+        lines = ['{:<30} {:>10} {:>12} {:>7} {:>10} {:>8} {:>11} {:>9}'.format('Model', 'Docs', 'Bytes', 'Errors', 'Docs/s', 'DB (s)', 'Serial. (s)', 'Net. (s)')]
+        for model_name, stats in self.summary().items():
+            lines.append('{:<30} {:>10} {:>12} {:>7} {:>10.0f} {:>8.2f} {:>11.2f} {:>9.2f}'.format(model_name, stats['docs'], stats['bytes'], stats['errors'], stats['docs_per_second'], stats['db'], stats['serialize'], stats['network']))
+
+        for model_name, stats in self.summary().items():
+            if not stats['fields']:
+                continue
+            lines.append('')
+            lines.append('{:<30} {:>12} {:>14}'.format('{} field'.format(model_name), 'Time (s)', 'Per doc (us)'))
+            for name, seconds in sorted(stats['fields'].items(), key=lambda field: field[1], reverse=True):
+                lines.append('{:<30} {:>12.3f} {:>14.1f}'.format(name, seconds, seconds * 1e6 / stats['docs'] if stats['docs'] else 0))
+        return '\n'.join(lines)
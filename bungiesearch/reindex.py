@@ -0,0 +1,86 @@
+from datetime import datetime
+from multiprocessing.dummy import Pool
+
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import reindex as scan_and_bulk
+
+from . import Bungiesearch
+from .cache import invalidate_search_cache
+from .logger import logger
+from .utils import get_index_body
+
+# Timeout of each _reindex request, in seconds, as these only return once all the documents of a doctype are copied.
+REINDEX_REQUEST_TIMEOUT = 3600
+
+
+def reindex_from_source(index_name, thread_count=4, bulk_size=500, timeout=None):
+    '''
+    Rebuilds the provided index from the `_source` of its documents, without touching the database: a new index is
+    created with the current mappings and analysis, the documents are copied to it (one doctype per thread), and the index
+    name is swapped to point to it as an alias. The previous index is then deleted.
+
+    Documents are copied with the _reindex API on elasticsearch 2.3+, and with a scroll and bulk requests otherwise.
+    Changes indexed during the copy are not carried to the new index, and the new index is deleted if the copy fails.
+    If the index name is a concrete index rather than an alias, it is briefly missing before becoming an alias of the new
+    index: writes must be stopped beforehand, since a write in between recreates it.
+    :param index_name: name of the index (or alias) to rebuild, as defined in the settings.
+    :param thread_count: number of doctypes copied concurrently.
+    :param bulk_size: number of documents copied per request.
+    :param timeout: timeout of each request, except of the _reindex requests which use REINDEX_REQUEST_TIMEOUT.
+    :return: the name of the new index.
+    '''
+    es = Bungiesearch.get_write_es_instance(index_name, timeout=timeout)
+    # The index name may already be an alias of the index built by a previous run.
+    sources = sorted(es.indices.get_alias(index=index_name).keys())
+    is_alias = index_name not in sources
+    new_index = datetime.utcnow().strftime(Bungiesearch.REBUILT_INDEX_FORMAT.format(index_name))
+
+    body = get_index_body(index_name)
+    # Refreshing is disabled during the copy, which speeds up indexing.
+    body['settings']['refresh_interval'] = '-1'
+    logger.info('Creating index {} with {} doctypes.'.format(new_index, len(body['mappings'])))
+    es.indices.create(index=new_index, body=body)
+
+    version = tuple(int(number) for number in es.info()['version']['number'].split('.')[:2])
+    doc_types = Bungiesearch.get_models(index_name)
+
+    def copy(doc_type):
+        logger.info('Copying doctype {} from {} to {}.'.format(doc_type, ', '.join(sources), new_index))
+        if version >= (2, 3):
+            response = es.reindex(body={'source': {'index': sources, 'type': doc_type, 'size': bulk_size}, 'dest': {'index': new_index}}, wait_for_completion=True, request_timeout=REINDEX_REQUEST_TIMEOUT)
+            if response.get('failures'):
+                raise ValueError('{} document(s) of doctype {} failed to be copied: {}'.format(len(response['failures']), doc_type, response['failures'][0]))
+        else:
+            scan_and_bulk(es, ','.join(sources), new_index, chunk_size=bulk_size, scan_kwargs={'doc_type': doc_type})
+
+    pool = Pool(max(min(thread_count, len(doc_types)), 1))
+    try:
+        pool.map(copy, doc_types)
+    except Exception:
+        logger.error('Copying {} failed: deleting index {}.'.format(index_name, new_index))
+        es.indices.delete(index=new_index, ignore=404)
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+    es.indices.put_settings(index=new_index, body={'index': {'refresh_interval': '1s'}})
+    es.indices.refresh(index=new_index)
+
+    if is_alias:
+        actions = [{'remove': {'index': source, 'alias': index_name}} for source in sources]
+        actions.append({'add': {'index': new_index, 'alias': index_name}})
+        es.indices.update_aliases(body={'actions': actions})
+        es.indices.delete(index=','.join(sources))
+    else:
+        # An alias cannot have the name of an existing index, hence the index is briefly unavailable.
+        es.indices.delete(index=index_name)
+        try:
+            es.indices.put_alias(index=new_index, name=index_name)
+        except TransportError:
+            logger.error('Could not add alias {0} to index {1}, e.g. because a write recreated index {0} after it was deleted. The rebuilt documents are in index {1}: stop writes, delete index {0} and add the alias manually.'.format(index_name, new_index))
+            raise
+
+    invalidate_search_cache(index_name)
+    logger.info('Index {} now points to {}.'.format(index_name, new_index))
+    return new_index
@@ -1,11 +1,45 @@
-from collections import defaultdict
+import atexit
+import os
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from functools import partial
 from importlib import import_module
-from threading import Lock
+from threading import Condition, Lock, Thread, local
 
+from django.db import close_old_connections, transaction
 from django.db.models import signals
+from six import iteritems, text_type
 
 from . import Bungiesearch
-from .utils import delete_index_item, update_index
+from .logger import logger
+from .utils import delete_index_item, update_index, update_index_fields
+
+# Backpressure modes of the background signal processor when its queue is full.
+BACKPRESSURE_MODES = ('block', 'drop-oldest', 'sync')
+
+_muted = local()
+
+
+@contextmanager
+def muted_deletes(model):
+    '''
+    Within this context, signal processors do not delete the instances of this model deleted by the current thread from
+    the index, because they are deleted in bulk instead.
+    '''
+    muted = getattr(_muted, 'models', set())
+    _muted.models = muted | set([model])
+    try:
+        yield
+    finally:
+        _muted.models = muted
+
+
+def deletes_muted(model):
+    '''
+    Returns True if the deletes of this model by the current thread are muted by `muted_deletes`.
+    '''
+    return model in getattr(_muted, 'models', ())
 
 
 def get_signal_processor():
@@ -20,9 +54,111 @@ def get_signal_processor():
 
 
 class BungieSignalProcessor(object):
+    '''
+    Buffers saved instances per model and indexes them in bulk when the buffer of a model is full, or when all buffers
+    hold SIGNALS['MAX_BUFFERED_ITEMS'] items (if set). Buffers are also flushed once they are older than
+    SIGNALS['MAX_AGE'] seconds (if set), when the transaction of the save is committed (if SIGNALS['FLUSH_ON_COMMIT']
+    is set), and when the process exits.
 
+    Buffers are keyed by primary key, hence an object saved several times is only indexed once, in its latest state, and
+    deleting an object removes it from the buffer.
+    '''
     __index_lock = Lock()
-    __items_to_be_indexed = defaultdict(list)
+    __items_to_be_indexed = defaultdict(OrderedDict)
+    # Time at which the first item of each buffer was added.
+    __buffered_since = {}
+    # Process id in which the flush timer thread and the exit handler were started.
+    __started_pid = None
+
+    @classmethod
+    def get_setting(cls, name, default=None):
+        return Bungiesearch.BUNGIE['SIGNALS'].get(name, default)
+
+    @classmethod
+    def flush(cls, sender=None):
+        '''
+        Indexes the buffered items of the provided model, or of all models.
+        :param sender: model class, or None to flush all buffers.
+        '''
+        with cls.__index_lock:
+            buffers = cls.__pop_buffers([sender] if sender is not None else list(cls.__items_to_be_indexed.keys()))
+
+        cls.__index_buffers(buffers)
+
+    @classmethod
+    def __pop_buffers(cls, senders):
+        '''
+        Empties the buffers of the provided models and returns their items. Must be called with the index lock held.
+        '''
+        buffers = []
+        for sender in senders:
+            items = cls.__items_to_be_indexed.pop(sender, None)
+            cls.__buffered_since.pop(sender, None)
+            if items:
+                buffers.append((sender, list(items.values())))
+        return buffers
+
+    @classmethod
+    def __index_buffers(cls, buffers):
+        for sender, items in buffers:
+            # Items saved with `update_fields` are partially updated, grouped by their updated fields.
+            full_items, partial_items = [], defaultdict(list)
+            for instance, update_fields in items:
+                if update_fields is None:
+                    full_items.append(instance)
+                else:
+                    partial_items[update_fields].append(instance)
+
+            if full_items:
+                update_index(full_items, sender.__name__, bulk_size=len(full_items))
+            for update_fields, instances in iteritems(partial_items):
+                update_index_fields(instances, sender.__name__, update_fields, bulk_size=len(instances))
+
+    @classmethod
+    def flush_expired(cls, max_age):
+        '''
+        Indexes the buffered items of each model whose buffer is older than max_age seconds.
+        '''
+        now = time.time()
+        for sender, since in list(cls.__buffered_since.items()):
+            if now - since >= max_age:
+                cls.flush(sender)
+
+    @classmethod
+    def _flush_expired_forever(cls, max_age):
+        while True:
+            time.sleep(min(max_age, 1))
+            try:
+                cls.flush_expired(max_age)
+            except Exception as e:
+                logger.exception('Could not flush the signal buffers: {}.'.format(e))
+            finally:
+                close_old_connections()
+
+    @classmethod
+    def _flush_at_exit(cls):
+        try:
+            cls.flush()
+        except Exception as e:
+            logger.exception('Could not flush the signal buffers at exit: {}.'.format(e))
+
+    @classmethod
+    def _start(cls):
+        '''
+        Starts the flush timer thread (if SIGNALS['MAX_AGE'] is set) and registers the exit handler, once per process.
+        '''
+        with cls.__index_lock:
+            if cls.__started_pid == os.getpid():
+                return
+            if cls.__started_pid is None:
+                atexit.register(cls._flush_at_exit)
+            cls.__started_pid = os.getpid()
+
+        max_age = cls.get_setting('MAX_AGE')
+        if max_age:
+            timer = Thread(target=cls._flush_expired_forever, args=(max_age,), name='bungiesearch-signal-flush')
+            timer.daemon = True
+            timer.start()
 
     def post_save_connector(self, sender, instance, **kwargs):
         try:
@@ -30,21 +166,34 @@ class BungieSignalProcessor(object):
         except KeyError:
             return  # This model is not managed by Bungiesearch.
 
-        try:
-            buffer_size = Bungiesearch.BUNGIE['SIGNALS']['BUFFER_SIZE']
-        except KeyError:
-            buffer_size = 100
+        buffer_size = self.get_setting('BUFFER_SIZE', 100)
+        update_fields = kwargs.get('update_fields')
+        max_buffered_items = self.get_setting('MAX_BUFFERED_ITEMS')
+        if self.__started_pid != os.getpid():
+            self._start()
 
-        items = None
+        buffers = None
         with self.__index_lock:
-            self.__items_to_be_indexed[sender].append(instance)
-            if len(self.__items_to_be_indexed[sender]) >= buffer_size:
-                items = self.__items_to_be_indexed[sender]
-                # Let's now empty this buffer.
-                self.__items_to_be_indexed[sender] = []
+            items = self.__items_to_be_indexed[sender]
+            # Last write wins: the latest instance replaces any buffered one, and moves to the end of the buffer. Only the
+            # fields updated by all its buffered saves need to be indexed, unless one of the saves updated all fields.
+            _, buffered_fields = items.pop(instance.pk, (None, frozenset()))
+            if update_fields is not None and buffered_fields is not None:
+                update_fields = buffered_fields.union(update_fields)
+            else:
+                update_fields = None
+            items[instance.pk] = (instance, update_fields)
+            self.__buffered_since.setdefault(sender, time.time())
+            if len(items) >= buffer_size:
+                buffers = self.__pop_buffers([sender])
+            elif max_buffered_items and sum(len(buffered) for buffered in self.__items_to_be_indexed.values()) >= max_buffered_items:
+                buffers = self.__pop_buffers(list(self.__items_to_be_indexed.keys()))
 
-        if items:
-            update_index(items, sender.__name__, bulk_size=buffer_size)
+        if buffers:
+            self.__index_buffers(buffers)
+        elif self.get_setting('FLUSH_ON_COMMIT', False) and transaction.get_connection(kwargs.get('using')).in_atomic_block:
+            # Outside of a transaction, the save is already committed and the item remains buffered.
+            transaction.on_commit(partial(self.flush, sender), using=kwargs.get('using'))
 
     def pre_delete_connector(self, sender, instance, **kwargs):
         try:
@@ -52,7 +201,13 @@ class BungieSignalProcessor(object):
         except KeyError:
             return  # This model is not managed by Bungiesearch.
 
-        delete_index_item(instance, sender.__name__)
+        with self.__index_lock:
+            # The object will no longer exist, hence it must not be indexed when its buffer is flushed.
+            if sender in self.__items_to_be_indexed:
+                self.__items_to_be_indexed[sender].pop(instance.pk, None)
+
+        if not deletes_muted(sender):
+            delete_index_item(instance, sender.__name__)
 
     def setup(self, model):
         signals.post_save.connect(self.post_save_connector, sender=model)
@@ -61,3 +216,265 @@ class BungieSignalProcessor(object):
     def teardown(self, model):
         signals.pre_delete.disconnect(self.pre_delete_connector, sender=model)
         signals.post_save.disconnect(self.post_save_connector, sender=model)
+
+
+class WorkerQueue(object):
+    '''
+    Bounded queue of one worker thread of BackgroundSignalProcessor. Its items are taken in order, and only once the
+    previously taken batch was processed, hence they are processed in order, even by a thread applying the 'sync'
+    backpressure.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = deque()
+        self.busy = False
+        self.condition = Condition()
+
+    def take(self, max_items=None):
+        '''
+        Waits until there are queued items and the previous batch was processed, then takes up to max_items items. The
+        batch must be released once processed.
+        '''
+        with self.condition:
+            while self.busy or not self.items:
+                self.condition.wait()
+            batch = []
+            while self.items and (max_items is None or len(batch) < max_items):
+                batch.append(self.items.popleft())
+            self.busy = True
+            self.condition.notify_all()
+        return batch
+
+    def release(self):
+        '''
+        Marks the taken batch as processed.
+        '''
+        with self.condition:
+            self.busy = False
+            self.condition.notify_all()
+
+    def join(self):
+        '''
+        Waits until all the queued items were processed.
+        '''
+        with self.condition:
+            while self.busy or self.items:
+                self.condition.wait()
+
+
+class BackgroundSignalProcessor(BungieSignalProcessor):
+    '''
+    Queues saved and deleted instances on bounded in-process queues, one per worker thread (SIGNALS['WORKERS']), which
+    index up to SIGNALS['BUFFER_SIZE'] items per bulk request. All the items of a document are queued for the same worker,
+    hence they are indexed in the order of the saves and deletes. Saves never wait for elasticsearch unless the queue is
+    full, in which case SIGNALS['BACKPRESSURE'] applies: 'block' waits for room in the queue, 'drop-oldest' discards the
+    oldest queued item, and 'sync' indexes the queued items and the item in the saving thread.
+    '''
+    _queues = None
+    _started_pid = None
+    _metrics_lock = Lock()
+    _metrics = {'processed': 0, 'dropped': 0, 'errors': 0, 'sync': 0}
+
+    @classmethod
+    def _start(cls):
+        '''
+        Creates the queues and starts the worker threads, once per process.
+        '''
+        with cls._metrics_lock:
+            if cls._started_pid == os.getpid():
+                return
+            if cls._started_pid is None:
+                atexit.register(cls._drain)
+            backpressure = cls.get_setting('BACKPRESSURE', 'block')
+            if backpressure not in BACKPRESSURE_MODES:
+                raise ValueError('SIGNALS["BACKPRESSURE"] must be one of {} (got {}).'.format(BACKPRESSURE_MODES, backpressure))
+            workers = max(cls.get_setting('WORKERS', 2), 1)
+            cls._queues = [WorkerQueue(max(cls.get_setting('QUEUE_SIZE', 10000) // workers, 1)) for _ in range(workers)]
+            cls._started_pid = os.getpid()
+
+            for worker_num, queue in enumerate(cls._queues):
+                worker = Thread(target=cls._work, args=(queue,), name='bungiesearch-signal-worker-{}'.format(worker_num))
+                worker.daemon = True
+                worker.start()
+
+    @classmethod
+    def get_metrics(cls):
+        '''
+        Returns a dictionary with the number of queued items (`depth`), the number of seconds the oldest queued item has
+        been waiting for (`lag`), and the number of items processed, dropped, indexed synchronously (`sync`) and failed
+        (`errors`) since the process started.
+        '''
+        metrics = dict(cls._metrics, depth=0, lag=0)
+        if cls._queues is not None and cls._started_pid == os.getpid():
+            now = time.time()
+            for queue in cls._queues:
+                with queue.condition:
+                    metrics['depth'] += len(queue.items)
+                    if queue.items:
+                        metrics['lag'] = max(metrics['lag'], now - queue.items[0][3])
+        return metrics
+
+    @classmethod
+    def join(cls):
+        '''
+        Waits until all the queued items were processed.
+        '''
+        if cls._queues is not None and cls._started_pid == os.getpid():
+            for queue in cls._queues:
+                queue.join()
+
+    @classmethod
+    def _count(cls, metric, value=1):
+        with cls._metrics_lock:
+            cls._metrics[metric] += value
+
+    @classmethod
+    def _process(cls, batch):
+        '''
+        Indexes or deletes the items of the batch, with one bulk request per consecutive run of the same action and model.
+        '''
+        runs = []
+        for action, sender, instance, _ in batch:
+            if runs and runs[-1][0] == action and runs[-1][1] == sender:
+                runs[-1][2].append(instance)
+            else:
+                runs.append((action, sender, [instance]))
+
+        for action, sender, instances in runs:
+            try:
+                if action == 'delete':
+                    update_index(instances, sender.__name__, action='delete', bulk_size=len(instances))
+                else:
+                    update_index(instances, sender.__name__, bulk_size=len(instances))
+            except Exception as e:
+                cls._count('errors', len(instances))
+                logger.exception('Could not {} {} {} items: {}.'.format(action, len(instances), sender.__name__, e))
+            else:
+                cls._count('processed', len(instances))
+
+    @classmethod
+    def _work(cls, queue):
+        buffer_size = cls.get_setting('BUFFER_SIZE', 100)
+        while True:
+            batch = queue.take(buffer_size)
+            try:
+                cls._process(batch)
+            finally:
+                close_old_connections()
+                queue.release()
+
+    @classmethod
+    def _drain(cls):
+        '''
+        Processes the queued items in the current thread, e.g. at exit. Batches being processed by the workers are not
+        waited for, as they may be stuck on an unavailable cluster.
+        '''
+        if cls._queues is None or cls._started_pid != os.getpid():
+            return
+        batch = []
+        for queue in cls._queues:
+            with queue.condition:
+                batch.extend(queue.items)
+                queue.items.clear()
+        if batch:
+            cls._process(batch)
+
+    def enqueue(self, action, sender, instance, document_id=None):
+        '''
+        Queues an item on the queue of its document, applying the backpressure mode if that queue is full.
+        :param action: 'index' or 'delete'.
+        :param sender: model class.
+        :param instance: instance to index, or document id to delete.
+        :param document_id: id of the document, defaults to `instance`.
+        '''
+        if self._started_pid != os.getpid():
+            self._start()
+
+        item = (action, sender, instance, time.time())
+        queue = self._queues[hash((sender, text_type(instance if document_id is None else document_id))) % len(self._queues)]
+        backpressure = self.get_setting('BACKPRESSURE', 'block')
+        batch = None
+        with queue.condition:
+            if backpressure == 'block':
+                while len(queue.items) >= queue.maxsize:
+                    queue.condition.wait()
+            elif len(queue.items) >= queue.maxsize:
+                if backpressure == 'sync':
+                    # The queued items are processed first, once the batch taken by the worker was processed.
+                    while queue.busy:
+                        queue.condition.wait()
+                    batch = list(queue.items) + [item]
+                    queue.items.clear()
+                    queue.busy = True
+                else:
+                    queue.items.popleft()
+                    self._count('dropped')
+                    logger.warning('Signal queue is full: dropped the oldest queued item.')
+            if batch is None:
+                queue.items.append(item)
+                queue.condition.notify_all()
+
+        if batch is not None:
+            self._count('sync')
+            try:
+                self._process(batch)
+            finally:
+                queue.release()
+
+    def post_save_connector(self, sender, instance, **kwargs):
+        try:
+            Bungiesearch.get_index(sender, via_class=True)
+        except KeyError:
+            return  # This model is not managed by Bungiesearch.
+
+        self.enqueue('index', sender, instance, Bungiesearch.get_model_index(sender.__name__).fields['_id'].value(instance))
+
+    def pre_delete_connector(self, sender, instance, **kwargs):
+        try:
+            Bungiesearch.get_index(sender, via_class=True)
+        except KeyError:
+            return  # This model is not managed by Bungiesearch.
+        if deletes_muted(sender):
+            return
+
+        # Django resets the primary key of deleted instances, hence the document id is queued instead.
+        self.enqueue('delete', sender, Bungiesearch.get_model_index(sender.__name__).fields['_id'].value(instance))
+
+
+class OutboxSignalProcessor(BungieSignalProcessor):
+    '''
+    Records saved and deleted instances in the IndexingOutbox table. The outbox is sent to elasticsearch by
+    `search_index --drain-outbox`. Requires `bungiesearch` in INSTALLED_APPS.
+
+    Django deletes objects in a transaction, in which deletes are recorded. However, `post_save` is only sent once the
+    save is committed unless it happens within an atomic block (e.g. with ATOMIC_REQUESTS), hence saves must be made in
+    atomic blocks for no update to be lost if the process dies. A warning is logged for saves outside of atomic blocks.
+    '''
+    def record(self, action, sender, instance, using=None):
+        from .models import IndexingOutbox
+
+        if action == 'index' and not transaction.get_connection(using).in_atomic_block:
+            logger.warning('{} {} was saved outside of an atomic block: its outbox row is recorded in a separate transaction, and is lost if the process dies in between.'.format(sender.__name__, instance.pk))
+
+        document_id = None
+        if action == 'delete':
+            document_id = Bungiesearch.get_model_index(sender.__name__).fields['_id'].value(instance)
+        IndexingOutbox.objects.using(using).create(model_label='{}.{}'.format(sender._meta.app_label, sender.__name__), object_pk=instance.pk, document_id=document_id, action=action)
+
+    def post_save_connector(self, sender, instance, **kwargs):
+        try:
+            Bungiesearch.get_index(sender, via_class=True)
+        except KeyError:
+            return  # This model is not managed by Bungiesearch.
+
+        self.record('index', sender, instance, kwargs.get('using'))
+
+    def pre_delete_connector(self, sender, instance, **kwargs):
+        try:
+            Bungiesearch.get_index(sender, via_class=True)
+        except KeyError:
+            return  # This model is not managed by Bungiesearch.
+        if deletes_muted(sender):
+            return
+
+        self.record('delete', sender, instance, kwargs.get('using'))
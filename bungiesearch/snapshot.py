@@ -0,0 +1,120 @@
+import gzip
+import io
+import json
+
+from six import iteritems
+
+from elasticsearch.helpers import BulkIndexError, parallel_bulk, scan
+
+from . import Bungiesearch
+from .cache import invalidate_search_cache
+from .logger import logger
+from .utils import get_index_body
+
+# Key of the header, which is the first line of a snapshot.
+SNAPSHOT_HEADER_KEY = 'bungiesearch_snapshot'
+
+# Size of the buffer used to read snapshots, in bytes.
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Metadata of the hits which are kept in the bulk actions of a snapshot.
+HIT_METADATA = ('_type', '_id', '_routing', '_parent')
+
+
+def export_index(index_name, path, bulk_size=500, timeout=None):
+    '''
+    Scrolls all the documents of the provided index out to a gzip compressed file, in the newline delimited format of the
+    bulk API. The first line is a header holding the index name, and the mappings and analysis of its search indices.
+    Documents are written as they are scrolled, hence memory usage does not depend on the size of the index.
+    :param index_name: name of the index to export.
+    :param path: path of the snapshot file.
+    :param bulk_size: number of documents fetched per scroll request.
+    :return: the number of exported documents.
+    '''
+    es = Bungiesearch.get_write_es_instance(index_name, timeout=timeout)
+    serializer = es.transport.serializer
+    count = 0
+
+    with gzip.open(path, 'wb') as output:
+        _write_line(output, serializer, {SNAPSHOT_HEADER_KEY: {'index': index_name, 'body': get_index_body(index_name)}})
+        for hit in scan(es, index=index_name, size=bulk_size):
+            _write_line(output, serializer, {'index': dict((key, hit[key]) for key in HIT_METADATA if key in hit)})
+            _write_line(output, serializer, hit['_source'])
+            count += 1
+
+    logger.info('Exported {} documents of index {} to {}.'.format(count, index_name, path))
+    return count
+
+
+def import_index(path, index_name=None, bulk_size=500, thread_count=4, timeout=None):
+    '''
+    Streams a snapshot written by `export_index` into an index, with `thread_count` concurrent bulk requests. The index is
+    created with the mappings and analysis of the snapshot if it does not exist. At most `thread_count` requests of
+    `bulk_size` documents are held in memory at once.
+    :param path: path of the snapshot file.
+    :param index_name: name of the index to import into, defaults to the index the snapshot was exported from.
+    :param bulk_size: number of documents sent per bulk request.
+    :param thread_count: number of concurrent bulk requests.
+    :return: the number of imported documents.
+    '''
+    with gzip.open(path, 'rb') as snapshot:
+        lines = io.BufferedReader(snapshot, buffer_size=READ_BUFFER_SIZE)
+        header = json.loads(next(lines).decode('utf-8'))
+        if SNAPSHOT_HEADER_KEY not in header:
+            raise ValueError('{} is not a bungiesearch snapshot.'.format(path))
+        header = header[SNAPSHOT_HEADER_KEY]
+        index_name = index_name or header['index']
+
+        es = Bungiesearch.get_write_es_instance(index_name, timeout=timeout)
+        if es.indices.exists(index=index_name):
+            logger.info('Importing {} into existing index {}.'.format(path, index_name))
+        else:
+            logger.info('Creating index {} with {} doctypes.'.format(index_name, len(header['body']['mappings'])))
+            es.indices.create(index=index_name, body=header['body'])
+
+        count = 0
+        errors = []
+        num_errors = 0
+        # parallel_bulk consumes its whole input upfront, hence the actions are passed in batches of one request per thread.
+        for batch in _batches(_read_actions(lines, es.transport.serializer, index_name), bulk_size * thread_count):
+            for ok, item in parallel_bulk(es, batch, thread_count=thread_count, chunk_size=bulk_size, raise_on_error=False):
+                if ok:
+                    count += 1
+                else:
+                    num_errors += 1
+                    if len(errors) < bulk_size:
+                        errors.append(item)
+
+    es.indices.refresh(index=index_name)
+    invalidate_search_cache(index_name)
+    if num_errors:
+        raise BulkIndexError('{} document(s) failed to import.'.format(num_errors), errors)
+
+    logger.info('Imported {} documents from {} into index {}.'.format(count, path, index_name))
+    return count
+
+
+def _write_line(output, serializer, data):
+    output.write((serializer.dumps(data) + '\n').encode('utf-8'))
+
+
+def _read_actions(lines, serializer, index_name):
+    '''
+    Yields the bulk actions of a snapshot, each with its source, targeting the provided index.
+    '''
+    for line in lines:
+        op_type, metadata = next(iteritems(serializer.loads(line.decode('utf-8'))))
+        action = dict(metadata, _op_type=op_type, _index=index_name)
+        action['_source'] = serializer.loads(next(lines).decode('utf-8'))
+        yield action
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
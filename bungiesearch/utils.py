@@ -1,9 +1,24 @@
+import json
+import os
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from multiprocessing.dummy import Pool
+from threading import Lock
+
 from dateutil.parser import parse as parsedt
+from django.apps import apps
+from django.db import connections, transaction
+from django.db.models import Max, Min
 from django.utils import timezone
+from six import iteritems, text_type
 
 from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import BulkIndexError, expand_action
+from elasticsearch.serializer import JSONSerializer
 
 from . import Bungiesearch
+from .cache import invalidate_search_cache
 from .logger import logger
 
 try:
@@ -11,8 +26,14 @@ try:
 except ImportError:
     from elasticsearch.helpers import bulk as bulk_index
 
+# Key of the mapping fingerprint in the `_meta` of each doctype.
+FINGERPRINT_META_KEY = 'bungiesearch_fingerprint'
+
+# Field attributes which elasticsearch omits from live mappings when they have their default value.
+DEFAULT_FIELD_ATTRIBUTES = {'index': 'analyzed', 'store': False, 'boost': 1.0, 'include_in_all': True}
 
-def update_index(model_items, model_name, action='index', bulk_size=100, num_docs=-1, start_date=None, end_date=None, refresh=True):
+
+def update_index(model_items, model_name, action='index', bulk_size=100, num_docs=-1, start_date=None, end_date=None, refresh=True, progress=None, dry_run=False, dry_run_output=None, checkpoint=None):
     '''
     Updates the index for the provided model_items.
     :param model_items: a list of model_items (django Model instances, or proxy instances) which are to be indexed/updated or deleted.
@@ -26,6 +47,11 @@ def update_index(model_items, model_name, action='index', bulk_size=100, num_doc
     :param end_date: end date for indexing. Must be as YYYY-MM-DD.
     :param refresh: a boolean that determines whether to refresh the index, making all operations performed since the last refresh
     immediately available for search, instead of needing to wait for the scheduled Elasticsearch execution. Defaults to True.
+    :param progress: an optional `bungiesearch.progress.IndexingProgress` instance which records the statistics of each bulk request.
+    :param dry_run: set to True to fetch and serialize the items without sending them to elasticsearch. The time spent computing
+    each field is then recorded in `progress`.
+    :param dry_run_output: optional file object to which the bulk actions are written (as in the bulk API) when dry_run is True.
+    :param checkpoint: optional callable, called with the last item of each bulk request once it has been sent.
     :note: If model_items contain multiple models, then num_docs is applied to *each* model. For example, if bulk_size is set to 5,
     and item contains models Article and Article2, then 5 model_items of Article *and* 5 model_items of Article2 will be indexed.
     '''
@@ -36,6 +62,8 @@ def update_index(model_items, model_name, action='index', bulk_size=100, num_doc
 
     logger.info('Getting index for model {}.'.format(model_name))
     for index_name in src.get_index(model_name):
+        es = src.get_write_es_instance(index_name) if not dry_run else None
+        serializer = es.transport.serializer if es is not None else JSONSerializer()
         index_instance = src.get_model_index(model_name)
         model = index_instance.get_model()
 
@@ -52,16 +80,195 @@ def update_index(model_items, model_name, action='index', bulk_size=100, num_doc
             logger.warning('Limiting the number of model_items to {} to {}.'.format(action, num_docs))
 
         logger.info('{} {} documents on index {}'.format(action, num_docs, index_name))
+        if progress is not None:
+            progress.start(model_name, index_name, num_docs)
         prev_step = 0
         max_docs = num_docs + bulk_size if num_docs > bulk_size else bulk_size + 1
         for next_step in range(bulk_size, max_docs, bulk_size):
             logger.info('{}: documents {} to {} of {} total on index {}.'.format(action.capitalize(), prev_step, next_step, num_docs, index_name))
-            data = create_indexed_document(index_instance, model_items[prev_step:next_step], action)
-            bulk_index(src.get_es_instance(), data, index=index_name, doc_type=model.__name__, raise_on_error=True)
+            start = time.time()
+            items = model_items[prev_step:next_step]
+            if not isinstance(items, (list, tuple)):
+                items = list(items)
+            fetched = time.time()
+            field_timings = {} if dry_run and progress is not None else None
+            data, size = serialize_documents(create_indexed_document(index_instance, items, action, field_timings), serializer)
+            serialized = time.time()
+            if dry_run:
+                errors = []
+                if dry_run_output is not None:
+                    write_bulk_actions(dry_run_output, data, index_name, model.__name__, serializer)
+            else:
+                _, errors = bulk_index(es, data, index=index_name, doc_type=model.__name__, raise_on_error=False)
+            if progress is not None:
+                progress.update(model_name, len(data), size, len(errors), db=fetched - start, serialize=serialized - fetched, network=time.time() - serialized, fields=field_timings)
+
+            if action == 'delete':
+                # Deleting documents which are not in the index is not an error, as in delete_index_item.
+                errors = [error for error in errors if error.get('delete', {}).get('status') != 404]
+            if errors:
+                raise BulkIndexError('{} document(s) failed to {}.'.format(len(errors), action), errors)
+            if checkpoint is not None and items:
+                checkpoint(items[-1])
             prev_step = next_step
 
+        if dry_run:
+            continue
+
         if refresh:
-            src.get_es_instance().indices.refresh(index=index_name)
+            es.indices.refresh(index=index_name)
+
+        invalidate_search_cache(index_name)
+
+
+def update_index_windows(model_items, model_name, start_date=None, end_date=None, windows=4, split_by='time', bulk_size=100, progress=None, checkpoints=None, dry_run=False, dry_run_output=None):
+    '''
+    Updates the index for the provided model_items between start_date and end_date, split into several windows of their
+    updated field which are indexed concurrently (one thread each). Each window records the updated field of its last
+    indexed item in `checkpoints`, hence an interrupted run resumes where each window stopped.
+    :param model_items: queryset of the items to index.
+    :param model_name: doctype, which must also be the model name.
+    :param start_date: start date for indexing, defaults to the oldest item.
+    :param end_date: end date for indexing, defaults to the most recent item.
+    :param windows: number of windows, i.e. of concurrent threads.
+    :param split_by: 'time' to split the period into windows of equal duration, or 'rows' to split it into windows with about
+    the same number of items (which costs one query per window).
+    :param checkpoints: optional `IndexingCheckpoints` instance in which the limits and the progress of each window are
+    stored. Limits are computed once, hence a resumed run uses the same windows even if items were updated since.
+    The other parameters are those of `update_index`.
+    '''
+    index_instance = Bungiesearch.get_model_index(model_name)
+    updated_field = index_instance.updated_field
+    if updated_field is None:
+        raise ValueError('Model {} has no updated field, hence it cannot be indexed by windows.'.format(model_name))
+
+    model_items = model_items.order_by(updated_field, 'pk')
+    checkpoints = checkpoints if checkpoints is not None else IndexingCheckpoints()
+    limits_key = '{}:limits:{}:{}:{}:{}'.format(model_name, start_date or '', end_date or '', windows, split_by)
+    if checkpoints.get(limits_key):
+        limits = [__str_to_tzdate__(limit) for limit in checkpoints.get(limits_key)]
+        logger.info('Resuming {} with the windows of the checkpoint.'.format(model_name))
+    else:
+        limits = _get_window_limits(model_items, updated_field, start_date, end_date, windows, split_by)
+        if limits is None:
+            logger.info('No {} items to index.'.format(model_name))
+            return
+        checkpoints.set(limits_key, [limit.isoformat() for limit in limits])
+    start, end = limits[0], limits[-1]
+    periods = list(zip(limits[:-1], limits[1:]))
+    if dry_run_output is not None:
+        # Windows write their actions concurrently.
+        dry_run_output = _SynchronizedOutput(dry_run_output)
+
+    def index_window(window):
+        key = '{}:{}:{}'.format(model_name, window[0].isoformat(), window[1].isoformat())
+        state = checkpoints.get(key)
+        if state and state.get('done'):
+            logger.info('Window {} was already indexed.'.format(key))
+            return
+        window_start = state['last'] if state else window[0].isoformat()
+        window_end = window[1]
+        if window != periods[-1] and isinstance(window_end, datetime):
+            # Items updated at the limit between two windows belong to the next one.
+            window_end -= timedelta(microseconds=1)
+
+        def checkpoint(item):
+            checkpoints.set(key, {'last': getattr(item, updated_field).isoformat()})
+
+        try:
+            update_index(model_items, model_name, bulk_size=bulk_size, start_date=window_start, end_date=window_end.isoformat(), refresh=False, progress=progress, dry_run=dry_run, dry_run_output=dry_run_output, checkpoint=checkpoint)
+            checkpoints.set(key, {'done': True})
+        finally:
+            # Database connections are per thread.
+            connections.close_all()
+
+    logger.info('Indexing {} in {} windows from {} to {}.'.format(model_name, len(periods), start, end))
+    pool = Pool(len(periods))
+    try:
+        pool.map(index_window, periods)
+    finally:
+        pool.close()
+        pool.join()
+
+    if not dry_run:
+        for index_name in Bungiesearch.get_index(model_name):
+            Bungiesearch.get_write_es_instance(index_name).indices.refresh(index=index_name)
+
+
+def _get_window_limits(model_items, updated_field, start_date, end_date, windows, split_by):
+    '''
+    Returns the sorted limits of the windows of the period between start_date and end_date (defaulting to the oldest and
+    most recent items), or None if there is no item to index.
+    '''
+    bounds = model_items.aggregate(start=Min(updated_field), end=Max(updated_field))
+    start = __str_to_tzdate__(start_date) if start_date else bounds['start']
+    end = __str_to_tzdate__(end_date) if end_date else bounds['end']
+    if start is None or end is None:
+        return None
+
+    if split_by == 'rows':
+        in_period = model_items.filter(**{'{}__gte'.format(updated_field): start, '{}__lte'.format(updated_field): end})
+        count = in_period.count()
+        limits = [start] + [in_period.values_list(updated_field, flat=True)[count * num // windows] for num in range(1, windows) if count * num // windows < count] + [end]
+    else:
+        limits = [start + (end - start) * num // windows for num in range(windows)] + [end]
+    limits = sorted(set(limits))
+    if len(limits) == 1:
+        limits = [start, end]
+    return limits
+
+
+class _SynchronizedOutput(object):
+    '''
+    File object wrapper whose writes are serialized by a lock.
+    '''
+    def __init__(self, output):
+        self._output = output
+        self._lock = Lock()
+
+    def write(self, data):
+        with self._lock:
+            self._output.write(data)
+
+
+class IndexingCheckpoints(object):
+    '''
+    Thread safe store of the progress of indexing windows, persisted as JSON to the provided path (if any) on every change.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = Lock()
+        self._checkpoints = {}
+        if path and os.path.exists(path):
+            with open(path) as checkpoints_file:
+                self._checkpoints = json.load(checkpoints_file)
+
+    def get(self, key, default=None):
+        return self._checkpoints.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._checkpoints[key] = value
+            if self.path:
+                # Written to a temporary file first, so that an interruption does not leave a truncated file.
+                with open(self.path + '.tmp', 'w') as checkpoints_file:
+                    json.dump(self._checkpoints, checkpoints_file)
+                os.rename(self.path + '.tmp', self.path)
+
+
+def write_bulk_actions(output, data, index_name, doc_type, serializer):
+    '''
+    Writes the actions to the provided file object, in the newline delimited format of the bulk API.
+    '''
+    lines = []
+    for doc in data:
+        action, source = expand_action(doc)
+        action[next(iter(action))].update({'_index': index_name, '_type': doc_type})
+        lines.append(serializer.dumps(action) + '\n')
+        if source is not None:
+            lines.append(serializer.dumps(source) + '\n')
+    # Written at once, so that the actions of concurrent windows are not interleaved.
+    output.write(''.join(lines))
 
 
 def delete_index_item(item, model_name, refresh=True):
@@ -76,21 +283,133 @@ def delete_index_item(item, model_name, refresh=True):
 
     logger.info('Getting index for model {}.'.format(model_name))
     for index_name in src.get_index(model_name):
+        es = src.get_write_es_instance(index_name)
         index_instance = src.get_model_index(model_name)
         item_es_id = index_instance.fields['_id'].value(item)
         try:
-            src.get_es_instance().delete(index_name, model_name, item_es_id)
+            es.delete(index_name, model_name, item_es_id)
         except NotFoundError as e:
             logger.warning('NotFoundError: could not delete {}.{} from index {}: {}.'.format(model_name, item_es_id, index_name, str(e)))
 
         if refresh:
-            src.get_es_instance().indices.refresh(index=index_name)
+            es.indices.refresh(index=index_name)
+
+        invalidate_search_cache(index_name)
+
+
+def update_index_fields(model_items, model_name, update_fields, bulk_size=100, refresh=True):
+    '''
+    Updates the documents of the provided model_items with partial documents, which only contain the index fields which
+    depend on update_fields. Items which are not indexed yet are fully indexed. Falls back to `update_index` if these
+    index fields are unknown (cf. `ModelIndex.get_dependent_fields`).
+    :param model_items: a list of model instances.
+    :param model_name: doctype, which must also be the model name.
+    :param update_fields: names of the updated model attributes, e.g. as passed to `save`.
+    :param bulk_size: bulk size for indexing. Defaults to 100.
+    :param refresh: a boolean that determines whether to refresh the index. Defaults to True.
+    '''
+    src = Bungiesearch()
+    index_instance = src.get_model_index(model_name)
+    fields = index_instance.get_dependent_fields(update_fields)
+    if fields is None:
+        return update_index(model_items, model_name, bulk_size=bulk_size, refresh=refresh)
+    if not fields:
+        logger.debug('No indexed field of {} depends on {}: nothing to update.'.format(model_name, list(update_fields)))
+        return
+
+    id_field = index_instance.fields['_id']
+    for index_name in src.get_index(model_name):
+        es = src.get_write_es_instance(index_name)
+        for start in range(0, len(model_items), bulk_size):
+            # Document ids are returned as strings by elasticsearch.
+            items = dict((text_type(id_field.value(item)), item) for item in model_items[start:start + bulk_size] if index_instance.matches_indexing_condition(item))
+            data = [{'_op_type': 'update', '_id': doc_id, 'doc': index_instance.serialize_object(item, fields=fields)} for doc_id, item in iteritems(items)]
+            logger.info('Partially updating fields {} of {} {} documents on index {}.'.format(list(fields), len(data), model_name, index_name))
+            _, errors = bulk_index(es, data, index=index_name, doc_type=model_name, raise_on_error=False)
+
+            missing = [items[error['update']['_id']] for error in errors if error.get('update', {}).get('status') == 404]
+            errors = [error for error in errors if error.get('update', {}).get('status') != 404]
+            if errors:
+                raise BulkIndexError('{} document(s) failed to update.'.format(len(errors)), errors)
+            if missing:
+                bulk_index(es, create_indexed_document(index_instance, missing, 'index'), index=index_name, doc_type=model_name, raise_on_error=True)
+
+        if refresh:
+            es.indices.refresh(index=index_name)
+
+        invalidate_search_cache(index_name)
+
+
+def update_index_by_pk(model, pks, bulk_size=100, refresh=True):
+    '''
+    Indexes the objects of the provided primary keys, with one database query and one bulk request per chunk of
+    bulk_size objects. Primary keys of objects which do not exist are ignored.
+    :param model: model class.
+    :param pks: list of primary keys.
+    :param bulk_size: number of objects fetched and indexed together.
+    :param refresh: a boolean that determines whether to refresh the index once all objects are indexed.
+    '''
+    for start in range(0, len(pks), bulk_size):
+        items = list(model.objects.filter(pk__in=pks[start:start + bulk_size]))
+        if items:
+            update_index(items, model.__name__, bulk_size=bulk_size, refresh=refresh and start + bulk_size >= len(pks))
+
+
+def drain_outbox(batch_size=100, using='default'):
+    '''
+    Sends the operations recorded in the indexing outbox to elasticsearch, in batches of batch_size rows, until the outbox
+    is empty. Rows are claimed with `SELECT ... FOR UPDATE SKIP LOCKED` where supported, hence several drains may run
+    concurrently. Only the last operation of each object in a batch is sent, and rows are only deleted once sent.
+    :param batch_size: number of outbox rows claimed per batch.
+    :param using: database alias of the outbox.
+    :return: the number of outbox rows processed.
+    '''
+    from .models import IndexingOutbox
+
+    skip_locked = getattr(connections[using].features, 'has_select_for_update_skip_locked', False)
+    processed = 0
+    # Indices are refreshed once the outbox is empty rather than after each bulk request.
+    indices = set()
+    while True:
+        with transaction.atomic(using=using):
+            rows = IndexingOutbox.objects.using(using).order_by('id')
+            if skip_locked:
+                rows = rows.select_for_update(skip_locked=True)
+            rows = list(rows[:batch_size])
+            if not rows:
+                break
 
+            # Last write wins: rows are ordered, so each object keeps its latest operation.
+            latest = OrderedDict(((row.model_label, row.object_pk), row) for row in rows)
+            to_index, to_delete = defaultdict(list), defaultdict(list)
+            for (model_label, object_pk), row in latest.items():
+                if row.action == 'delete':
+                    to_delete[model_label].append(row.document_id)
+                else:
+                    to_index[model_label].append(object_pk)
 
-def create_indexed_document(index_instance, model_items, action):
+            for model_label, pks in to_index.items():
+                # Objects deleted since are not found, and their delete row follows.
+                update_index_by_pk(apps.get_model(model_label), pks, bulk_size=len(pks), refresh=False)
+                indices.update(Bungiesearch.get_index(apps.get_model(model_label).__name__))
+            for model_label, document_ids in to_delete.items():
+                update_index(document_ids, apps.get_model(model_label).__name__, action='delete', bulk_size=len(document_ids), refresh=False)
+                indices.update(Bungiesearch.get_index(apps.get_model(model_label).__name__))
+
+            IndexingOutbox.objects.using(using).filter(id__in=[row.id for row in rows]).delete()
+            processed += len(rows)
+            logger.info('Drained {} outbox rows ({} documents).'.format(len(rows), len(latest)))
+
+    for index_name in indices:
+        Bungiesearch.get_write_es_instance(index_name).indices.refresh(index=index_name)
+    return processed
+
+
+def create_indexed_document(index_instance, model_items, action, timings=None):
     '''
     Creates the document that will be passed into the bulk index function.
     Either a list of serialized objects to index, or a a dictionary specifying the primary keys of items to be delete.
+    The time spent computing each field is added to timings, if provided.
     '''
     data = []
     if action == 'delete':
@@ -99,10 +418,130 @@ def create_indexed_document(index_instance, model_items, action):
     else:
         for doc in model_items:
             if index_instance.matches_indexing_condition(doc):
-                data.append(index_instance.serialize_object(doc))
+                data.append(index_instance.serialize_object(doc, timings=timings))
     return data
 
 
+def serialize_documents(data, serializer):
+    '''
+    Returns the provided documents as bulk actions whose source is already serialized, which the bulk helpers send as is,
+    and the total length of these sources.
+    '''
+    actions, size = [], 0
+    for doc in data:
+        action, source = expand_action(doc)
+        op_type, metadata = next(iteritems(action))
+        action = dict(metadata, _op_type=op_type)
+        if source is not None:
+            action['_source'] = serializer.dumps(source)
+            size += len(action['_source'])
+        actions.append(action)
+    return actions, size
+
+
+def get_fingerprinted_mapping(index_instance, meta_fields=True):
+    '''
+    Returns the mapping of the provided model index, with its fingerprint stored in the `_meta` of the doctype.
+    '''
+    mapping = dict(index_instance.get_mapping(meta_fields=meta_fields))
+    mapping['_meta'] = {FINGERPRINT_META_KEY: index_instance.get_fingerprint()}
+    return mapping
+
+
+def get_index_body(index_name):
+    '''
+    Returns the body with which to create the provided index: the fingerprinted mappings of its models and their analysis.
+    '''
+    mappings = {}
+    analysis = {'analyzer': {}, 'tokenizer': {}, 'filter': {}}
+
+    for mdl_idx in Bungiesearch.get_model_indices(index_name):
+        mappings[mdl_idx.get_model().__name__] = get_fingerprinted_mapping(mdl_idx, meta_fields=False)
+
+        mdl_analysis = mdl_idx.collect_analysis()
+        for key in analysis.keys():
+            value = mdl_analysis.get(key)
+            if value is not None:
+                analysis[key].update(value)
+
+    return {'mappings': mappings, 'settings': {'analysis': analysis}}
+
+
+def get_live_fingerprint(live_mapping, model_name):
+    '''
+    Returns the fingerprint stored in the `_meta` of the doctype, as returned by the get mapping API of one index, or None.
+    '''
+    return live_mapping.get('mappings', {}).get(model_name, {}).get('_meta', {}).get(FINGERPRINT_META_KEY)
+
+
+def diff_mapping(live_mapping, mapping, path=''):
+    '''
+    Compares the fields of a live doctype mapping, as returned by the get mapping API, with those of a search index mapping.
+    Missing fields (including the sub-fields of objects and multi-fields) can be added to the live mapping, whereas fields
+    whose definition changed cannot be updated in place. Fields which are only in the live mapping are ignored.
+    :return: a tuple of the mapping of the fields to add (None if there are none), and of the list of incompatible changes.
+    '''
+    additions, conflicts = {}, []
+    live_properties = live_mapping.get('properties', {})
+    for name, field in iteritems(mapping.get('properties', {})):
+        if name not in live_properties:
+            additions[name] = field
+            continue
+
+        live_field = live_properties[name]
+        for attr, value in iteritems(field):
+            if attr in ('properties', 'fields'):
+                continue
+            live_value = live_field.get(attr, DEFAULT_FIELD_ATTRIBUTES.get(attr))
+            if _normalize_setting(live_value) != _normalize_setting(value):
+                conflicts.append('{}{}: {} changed from {} to {}'.format(path, name, attr, live_value, value))
+
+        for key in ('properties', 'fields'):
+            if key in field:
+                sub_additions, sub_conflicts = diff_mapping({'properties': live_field.get(key, {})}, {'properties': field[key]}, '{}{}.'.format(path, name))
+                conflicts.extend(sub_conflicts)
+                if sub_additions:
+                    # The field is sent whole: its other attributes are unchanged, or the mapping is not updated.
+                    additions[name] = field
+
+    return {'properties': additions} if additions else None, conflicts
+
+
+def diff_analysis(live_analysis, analysis):
+    '''
+    Compares the live analysis settings of an index with the analysis of its search indices. Analyzers, tokenizers and
+    filters cannot be added or changed while an index is open, hence any difference is incompatible.
+    :return: the list of incompatible changes.
+    '''
+    conflicts = []
+    for kind, definitions in iteritems(analysis):
+        for name, definition in iteritems(definitions):
+            live_definition = live_analysis.get(kind, {}).get(name)
+            if live_definition is None:
+                conflicts.append('{} {} added'.format(kind, name))
+            elif any(_normalize_setting(live_definition.get(key)) != _normalize_setting(value) for key, value in iteritems(definition)):
+                conflicts.append('{} {} changed from {} to {}'.format(kind, name, live_definition, definition))
+    return conflicts
+
+
+def _normalize_setting(value):
+    '''
+    Normalizes a mapping or settings value for comparison, since elasticsearch returns some of them as strings.
+    '''
+    if isinstance(value, dict):
+        return dict((key, _normalize_setting(val)) for key, val in iteritems(value))
+    if isinstance(value, (list, tuple)):
+        return [_normalize_setting(val) for val in value]
+    if isinstance(value, bool):
+        return text_type(value).lower()
+    if value is None:
+        return None
+    try:
+        return text_type(float(value))
+    except (TypeError, ValueError):
+        return text_type(value)
+
+
 def filter_model_items(index_instance, model_items, model_name, start_date, end_date):
     ''' Filters the model items queryset based on start and end date.'''
     if index_instance.updated_field is None:
@@ -117,4 +556,7 @@ def filter_model_items(index_instance, model_items, model_name, start_date, end_
 
 
 def __str_to_tzdate__(date_str):
-    return timezone.make_aware(parsedt(date_str), timezone.get_current_timezone())
+    date = parsedt(date_str)
+    if timezone.is_aware(date):
+        return date
+    return timezone.make_aware(date, timezone.get_current_timezone())
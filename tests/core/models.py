@@ -42,6 +42,7 @@ class User(models.Model):
 class NoUpdatedField(models.Model):
     field_title = models.TextField(db_index=True)
     field_description = models.TextField(blank=True)
+    author = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
 
     objects = BungiesearchManager()
 
@@ -44,8 +44,11 @@ class UserIndex(ModelIndex):
 
 
 class NoUpdatedFieldIndex(ModelIndex):
+    author_name = StringField(eval_as='obj.author.name if obj.author else ""', depends_on=['author'])
+
     class Meta:
         model = NoUpdatedField
         exclude = ('field_description',)
+        additional_fields = ('author',)
         optimize_queries = True
         indexing_query = NoUpdatedField.objects.defer(*exclude).select_related().all()
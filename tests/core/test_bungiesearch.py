@@ -1,12 +1,24 @@
+import json
+import os
+import sys
+import tempfile
 from datetime import datetime
+from unittest import skipIf
 
 from django.core.management import call_command
 from django.test import TestCase, override_settings
-from six import iteritems
+from six import StringIO, iteritems
 
 import pytz
 from bungiesearch import Bungiesearch
-from bungiesearch.utils import update_index
+from bungiesearch.models import IndexingOutbox
+from bungiesearch.progress import IndexingProgress
+from bungiesearch.signals import (BackgroundSignalProcessor,
+                                  BungieSignalProcessor, OutboxSignalProcessor,
+                                  muted_deletes)
+from bungiesearch.snapshot import export_index, import_index
+from bungiesearch.utils import (IndexingCheckpoints, diff_mapping, update_index,
+                                update_index_windows)
 from core.bungie_signal import BungieTestSignalProcessor
 from core.models import (Article, ManangedButEmpty, NoUpdatedField, Unmanaged,
                          User)
@@ -103,6 +115,30 @@ class CoreTestCase(TestCase):
         self.assertEqual(ArticleIndex().get_mapping(), expected_article)
         self.assertEqual(UserIndex().get_mapping(), expected_user)
 
+    def test_mapping_fingerprint(self):
+        '''
+        Check that the fingerprints stored when creating the index match the search indices.
+        '''
+        article_index = ArticleIndex()
+        self.assertIs(article_index.get_mapping(), article_index.get_mapping())
+        self.assertEqual(article_index.get_fingerprint(), ArticleIndex().get_fingerprint())
+        self.assertNotEqual(article_index.get_fingerprint(), UserIndex().get_fingerprint())
+        call_command('search_index', action='check')
+
+    def test_mapping_diff(self):
+        '''
+        Check that the live mappings match the search indices, and that changes are classified as additive or incompatible.
+        '''
+        mapping = ArticleIndex().get_mapping(meta_fields=False)
+        live_mapping = Bungiesearch.get_write_es_instance().indices.get_mapping(index='bungiesearch_demo', doc_type='Article')
+        self.assertEqual(diff_mapping(next(iter(live_mapping.values()))['mappings']['Article'], mapping), (None, []))
+
+        live_mapping = {'properties': dict((name, dict(field, analyzer='standard') if name == 'description' else field) for name, field in iteritems(mapping['properties']) if name != 'title')}
+        additions, conflicts = diff_mapping(live_mapping, mapping)
+        self.assertEqual(list(additions['properties'].keys()), ['title'])
+        self.assertEqual(len(conflicts), 1)
+        call_command('search_index', action='update-mapping')
+
     def test_fetch_item(self):
         '''
         Test searching and mapping.
@@ -141,6 +177,113 @@ class CoreTestCase(TestCase):
         self.assertEqual(len(lazy_search_user[:1]), 1, 'Get item with start=None and stop=1 did not return one item.')
         self.assertEqual(len(lazy_search_user[:2]), 2, 'Get item with start=None and stop=2 did not return two item.')
 
+    def test_len_reuses_response(self):
+        '''
+        Tests that the number of hits is taken from an executed search and that a page can be fetched with its total.
+        '''
+        expected = Article.objects.search_index('bungiesearch_demo').query('match', title='title').count()
+        lazy = Article.objects.search_index('bungiesearch_demo').query('match', title='title')
+        lazy.execute()
+        self.assertEqual(lazy._count, expected, 'Executing the search did not cache the number of hits.')
+        self.assertEqual(len(lazy), expected, 'Number of hits after execution is not the expected one.')
+
+        results, total = Article.objects.search_index('bungiesearch_demo').query('match', title='title').execute_page(0, 1)
+        self.assertEqual(len(results), 1, 'Executing a page of size one did not return one item.')
+        self.assertEqual(total, expected, 'Executing a page did not return the total number of hits.')
+
+    def test_cached_search(self):
+        '''
+        Tests that cached responses are reused and invalidated when the index is updated.
+        '''
+        search = Article.objects.search_index('bungiesearch_demo').query('match', title='cached').cache(ttl=60)
+        self.assertEqual(list(search), [], 'Searching for "cached" did not return an empty list.')
+        obj = Article.objects.create(title='Title cached', description='Cached', link='http://example.com/cached', tweet_count=1,
+                                     published=pytz.UTC.localize(datetime(year=2015, month=7, day=13)))
+        search = Article.objects.search_index('bungiesearch_demo').query('match', title='cached').cache(ttl=60)
+        self.assertEqual(list(search), [obj], 'Updating the index did not invalidate the cached response.')
+        obj.delete()
+
+    def test_multi_execute(self):
+        '''
+        Tests that several searches executed together return the same results as when executed separately.
+        '''
+        searches = [Article.objects.search.query('match', _all='Description'), User.objects.search.query('match', _all='second user'),
+                    Article.objects.custom_search(index='bungiesearch_demo', doc_type='Article').query('match', _all='Description')]
+        articles, users, raw_articles = Bungiesearch.multi_execute(searches)
+        self.assertEqual(articles, Article.objects.search.query('match', _all='Description').execute(), 'Multi search did not return the same articles.')
+        self.assertEqual(users, User.objects.search.query('match', _all='second user').execute(), 'Multi search did not return the same users.')
+        self.assertTrue(all([hasattr(item, 'meta') for item in raw_articles]), 'Multi search mapped the results of a raw search.')
+
+    @skipIf(sys.version_info < (3, 5), 'asyncio execution requires Python 3.5+.')
+    def test_async_execution(self):
+        '''
+        Tests that awaitable searches return the same results as their blocking counterparts.
+        Results are mapped in executor threads, which read the objects created in setUpClass.
+        '''
+        import asyncio
+        loop = asyncio.new_event_loop()
+        raw_search = lambda: Article.objects.custom_search(index='bungiesearch_demo', doc_type='Article').query('match', _all='Description')
+        mapped_search = lambda: Article.objects.search.query('match', _all='Description')
+        try:
+            # Awaitables are created outside of the loop, which is only looked up when they are awaited.
+            self.assertEqual(loop.run_until_complete(raw_search().acount()), raw_search().count(), 'Awaiting count did not return the number of hits.')
+            raw = loop.run_until_complete(raw_search().aexecute())
+            self.assertEqual([item.meta.id for item in raw], [item.meta.id for item in raw_search().execute()], 'Awaiting execute did not return the same hits.')
+
+            mapped = loop.run_until_complete(mapped_search().aexecute())
+            self.assertTrue(mapped and all(isinstance(item, Article) for item in mapped), 'Awaiting execute did not map the results.')
+            self.assertEqual([item.pk for item in mapped], [item.pk for item in mapped_search().execute()], 'Awaiting execute did not return the same objects.')
+        finally:
+            loop.close()
+
+    def test_execute_after(self):
+        '''
+        Tests that paginating with a cursor returns every item exactly once.
+        '''
+        search = Article.objects.search_index('bungiesearch_demo').sort('-published')
+        items, cursor = search.execute_after(size=1)
+        while cursor:
+            page, cursor = search.execute_after(cursor, size=1)
+            items.extend(page)
+        self.assertEqual(len(items), search.count(), 'Paginating with a cursor did not return all articles.')
+        self.assertEqual(len(set(item.pk for item in items)), len(items), 'Paginating with a cursor returned an article more than once.')
+        self.assertRaises(ValueError, Article.objects.search.sort('_score').execute_after)
+
+    def test_related_mapping(self):
+        '''
+        Tests that related lookups are cloned and that lookups which do not apply to a model are ignored when mapping.
+        '''
+        search = Article.objects.search.query('match', _all='Description')
+        related = search.select_related('no_such_relation').prefetch_related('no_such_relation')
+        self.assertEqual(related._select_related, ['no_such_relation'], 'Calling `select_related` did not store the lookup.')
+        self.assertEqual(search._select_related, [], 'Calling `select_related` modified the original search.')
+        self.assertEqual(related.execute(), search.execute(), 'Inapplicable related lookups changed the mapped results.')
+        self.assertTrue(search.select_related()._select_related, 'Calling `select_related` without fields did not select all relations.')
+
+        # Related objects of a page of results are fetched with a fixed number of queries.
+        objs = [NoUpdatedField.objects.create(field_title='Related', author=User.objects.create(user_id='related{}'.format(num), name='Related author')) for num in range(3)]
+        find_related = lambda: NoUpdatedField.objects.search.query('match', field_title='related')
+        try:
+            with self.assertNumQueries(1):
+                self.assertEqual(len([item.author.name for item in find_related().select_related('author').execute()]), 3)
+            with self.assertNumQueries(2):
+                self.assertEqual(len([item.author.name for item in find_related().prefetch_related('author').execute()]), 3)
+        finally:
+            for obj in objs:
+                obj.author.delete()
+                obj.delete()
+
+    def test_mapped_search_skips_source(self):
+        '''
+        Tests that `_source` is only transferred when results are not mapped or when explicitly requested.
+        '''
+        search = Article.objects.search.query('match', _all='Description')
+        search.execute()
+        self.assertTrue(all([dir(raw) == ['meta'] for raw in search.raw_results]), 'Mapped search transferred the document sources.')
+        search = Article.objects.search.query('match', _all='Description').fetch_source()
+        search.execute()
+        self.assertTrue(all([raw.title for raw in search.raw_results]), 'Mapped search with fetch_source did not transfer the document sources.')
+
     def test_no_results(self):
         '''
         Test empty results.
@@ -222,6 +365,13 @@ class CoreTestCase(TestCase):
         expected = {'query': {'bool': {'filter': [{'term': {'title': 'title filter'}}], 'must': [{'match': {'title': 'title query'}}]}}}
         self.assertEqual(alias_dictd, expected, 'Alias on Bungiesearch instance did not return the expected dictionary.')
 
+    def test_search_alias_binding(self):
+        Article.objects.bsearch_title_search('title')
+        self.assertIn('bsearch_title_search', vars(Bungiesearch), 'Loaded aliases were not bound to the Bungiesearch class.')
+        self.assertEqual(Article.objects.search.bsearch_title_search('title').to_dict(), {'query': {'match': {'title': 'title'}}})
+        self.assertRaises(ValueError, getattr, NoUpdatedField.objects.search, 'bsearch_title_search')
+        self.assertRaises(ValueError, getattr, NoUpdatedField.objects, 'bsearch_title_search')
+
     def test_search_alias_model(self):
         self.assertEqual(Article.objects.bsearch_get_alias_for_test().get_model(), Article, 'Unexpected get_model information on search alias.')
         self.assertEqual(Article.objects.search.bsearch_title('title query').bsearch_get_alias_for_test().get_model(), Article, 'Unexpected get_model information on search alias.')
@@ -246,6 +396,106 @@ class CoreTestCase(TestCase):
         # Let's now delete this object to test the post delete signal.
         obj.delete()
 
+    def test_buffer_flush(self):
+        Bungiesearch.BUNGIE['SIGNALS']['BUFFER_SIZE'] = 10
+        try:
+            obj = NoUpdatedField.objects.create(field_title='Buffered', field_description='Flushed on demand.')
+            find_buffered = lambda: NoUpdatedField.objects.search.query('match', field_title='buffered')
+            self.assertEqual(find_buffered().count(), 0, 'Buffered item was indexed before its buffer was full.')
+            BungieSignalProcessor.flush(NoUpdatedField)
+            self.assertEqual(find_buffered().count(), 1, 'Buffered item was not indexed when its buffer was flushed.')
+        finally:
+            Bungiesearch.BUNGIE['SIGNALS']['BUFFER_SIZE'] = 1
+        obj.delete()
+
+    def test_buffer_deduplication(self):
+        Bungiesearch.BUNGIE['SIGNALS']['BUFFER_SIZE'] = 10
+        try:
+            obj = NoUpdatedField.objects.create(field_title='Deduplicated', field_description='Saved twice.')
+            obj.field_title = 'Deduplicated again'
+            obj.save()
+            deleted = NoUpdatedField.objects.create(field_title='Cancelled', field_description='Deleted before the flush.')
+            deleted.delete()
+            BungieSignalProcessor.flush(NoUpdatedField)
+        finally:
+            Bungiesearch.BUNGIE['SIGNALS']['BUFFER_SIZE'] = 1
+        self.assertEqual(NoUpdatedField.objects.search.query('match', field_title='again').count(), 1, 'Latest state of the object was not indexed.')
+        self.assertEqual(NoUpdatedField.objects.search.query('match', field_title='cancelled').count(), 0, 'Deleted object was indexed when its buffer was flushed.')
+        obj.delete()
+
+    def test_background_signal_processor(self):
+        processor = BackgroundSignalProcessor()
+        obj = NoUpdatedField(pk=1000, field_title='Background', field_description='Indexed by a worker thread.')
+        find_background = lambda: NoUpdatedField.objects.search.query('match', field_title='background')
+
+        processor.post_save_connector(NoUpdatedField, obj)
+        BackgroundSignalProcessor.join()
+        self.assertEqual(find_background().count(), 1, 'Queued item was not indexed by the workers.')
+
+        processor.pre_delete_connector(NoUpdatedField, obj)
+        BackgroundSignalProcessor.join()
+        self.assertEqual(find_background().count(), 0, 'Queued item was not deleted by the workers.')
+        self.assertEqual(BackgroundSignalProcessor.get_metrics()['depth'], 0)
+
+    def test_background_signal_processor_ordering(self):
+        processor = BackgroundSignalProcessor()
+        objs = [NoUpdatedField(pk=1100 + num, field_title='Ordered', field_description='Saved then deleted.') for num in range(10)]
+        for obj in objs:
+            processor.post_save_connector(NoUpdatedField, obj)
+            processor.pre_delete_connector(NoUpdatedField, obj)
+        BackgroundSignalProcessor.join()
+        self.assertEqual(NoUpdatedField.objects.search.query('match', field_title='ordered').count(), 0, 'A delete was processed before the save of the same object.')
+
+    def test_outbox_signal_processor(self):
+        processor = OutboxSignalProcessor()
+        obj = NoUpdatedField.objects.create(field_title='Outbox', field_description='Deleted from the outbox.')
+        find_outbox = lambda: NoUpdatedField.objects.search.query('match', field_title='outbox')
+        self.assertEqual(find_outbox().count(), 1)
+
+        processor.post_save_connector(NoUpdatedField, obj)
+        processor.pre_delete_connector(NoUpdatedField, obj)
+        self.assertEqual(IndexingOutbox.objects.count(), 2)
+        call_command('search_index', action='drain-outbox')
+        self.assertEqual(IndexingOutbox.objects.count(), 0, 'Drained outbox rows were not removed.')
+        self.assertEqual(find_outbox().count(), 0, 'Only the last operation of the object (delete) should have been sent.')
+
+        # Deletes in bulk are sent to elasticsearch directly.
+        with muted_deletes(NoUpdatedField):
+            processor.pre_delete_connector(NoUpdatedField, obj)
+        self.assertEqual(IndexingOutbox.objects.count(), 0, 'Muted delete was recorded in the outbox.')
+        obj.delete()
+
+    def test_bulk_operations_indexed(self):
+        NoUpdatedField.objects.bulk_create_indexed([NoUpdatedField(pk=2000 + num, field_title='Bulkcreated', field_description='Created in bulk.') for num in range(3)])
+        find_created = lambda: NoUpdatedField.objects.search.query('match', field_title='bulkcreated')
+        self.assertEqual(find_created().count(), 3, 'Objects created in bulk were not indexed.')
+
+        NoUpdatedField.objects.filter(pk__gte=2000).update_indexed(field_title='Bulkupdated')
+        find_updated = lambda: NoUpdatedField.objects.search.query('match', field_title='bulkupdated')
+        self.assertEqual(find_created().count(), 0)
+        self.assertEqual(find_updated().count(), 3, 'Objects updated in bulk were not reindexed.')
+
+        NoUpdatedField.objects.filter(pk__gte=2000).delete_indexed()
+        self.assertEqual(find_updated().count(), 0, 'Objects deleted in bulk were not deleted from the index.')
+
+    def test_partial_update(self):
+        nuf_index = Bungiesearch.get_model_index('NoUpdatedField')
+        self.assertEqual(nuf_index.get_dependent_fields(['field_title']), set(['field_title']))
+        self.assertEqual(nuf_index.get_dependent_fields(['field_description']), set())
+        self.assertEqual(nuf_index.get_dependent_fields(['author_id']), set(['author_name']), 'Attnames of foreign keys should be resolved.')
+        self.assertIsNone(ArticleIndex().get_dependent_fields(['title']), 'Article has computed fields without declared dependencies.')
+
+        obj = NoUpdatedField.objects.create(field_title='Complete', field_description='Partially updated.')
+        obj.field_title = 'Partial'
+        obj.save(update_fields=['field_title'])
+        self.assertEqual(NoUpdatedField.objects.search.query('match', field_title='partial').count(), 1, 'Partial update was not applied.')
+
+        obj.author = User.objects.create(user_id='partial', name='Partial author')
+        obj.save(update_fields=['author_id'])
+        self.assertEqual(NoUpdatedField.objects.search.query('match', author_name='author').count(), 1, 'Partial update of a foreign key was not applied.')
+        obj.author.delete()
+        obj.delete()
+
     def test_bulk_delete(self):
         '''
         This tests that using the update_index function with 'delete' as the action performs a bulk delete operation on the data.
@@ -296,6 +546,56 @@ class CoreTestCase(TestCase):
         update_index(Article.objects.all(), 'Article', start_date=datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M'))
         update_index(NoUpdatedField.objects.all(), 'NoUpdatedField', end_date=datetime.strftime(datetime.now(), '%Y-%m-%d'))
 
+    def test_indexing_progress(self):
+        progress = IndexingProgress()
+        update_index(NoUpdatedField.objects.all(), 'NoUpdatedField', bulk_size=1, progress=progress)
+        stats = progress.summary()['NoUpdatedField']
+        self.assertEqual(stats['docs'], stats['total'])
+        self.assertEqual(stats['errors'], 0)
+        self.assertGreater(stats['bytes'], 0)
+        self.assertIn('NoUpdatedField', progress.format_summary())
+
+    def test_indexing_dry_run(self):
+        progress = IndexingProgress()
+        output = StringIO()
+        update_index(NoUpdatedField.objects.all(), 'NoUpdatedField', bulk_size=1, progress=progress, dry_run=True, dry_run_output=output)
+        stats = progress.summary()['NoUpdatedField']
+        self.assertEqual(stats['docs'], NoUpdatedField.objects.count())
+        self.assertIn('field_title', stats['fields'])
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 2 * stats['docs'])
+        self.assertEqual(json.loads(lines[0])['index']['_type'], 'NoUpdatedField')
+
+    def test_update_index_windows(self):
+        for split_by in ('time', 'rows'):
+            progress = IndexingProgress()
+            update_index_windows(Article.objects.all(), 'Article', windows=3, split_by=split_by, progress=progress, dry_run=True)
+            self.assertEqual(progress.summary()['Article']['docs'], Article.objects.count() * len(Bungiesearch.get_index('Article')), 'Windows did not index each item exactly once (split by {}).'.format(split_by))
+
+        # Windows are computed once, hence a resumed run skips those already indexed even if the period changed since.
+        checkpoints = IndexingCheckpoints()
+        update_index_windows(Article.objects.all(), 'Article', windows=3, checkpoints=checkpoints, dry_run=True)
+        progress = IndexingProgress()
+        update_index_windows(Article.objects.all(), 'Article', windows=3, progress=progress, checkpoints=checkpoints, dry_run=True)
+        self.assertNotIn('Article', progress.summary(), 'Windows indexed by a previous run were indexed again.')
+
+    def test_snapshot_export_import(self):
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.json.gz')
+        exported = export_index('bungiesearch_demo', path)
+        es = Bungiesearch.get_write_es_instance()
+        try:
+            self.assertEqual(import_index(path, 'bungiesearch_demo_copy', bulk_size=2), exported)
+            self.assertEqual(es.count(index='bungiesearch_demo_copy')['count'], es.count(index='bungiesearch_demo')['count'])
+        finally:
+            es.indices.delete(index='bungiesearch_demo_copy', ignore=404)
+
+    def test_reindex_from_source(self):
+        count = Article.objects.search_index('bungiesearch_demo').count()
+        call_command('search_index', action='reindex-from-source', index='bungiesearch_demo')
+        self.assertEqual(Article.objects.search_index('bungiesearch_demo').count(), count)
+        self.assertIsInstance(Article.objects.search.query('match', title='one')[0], Article, 'Results of the rebuilt index were not mapped to models.')
+        call_command('search_index', action='check')
+
     def test_optimal_queries(self):
         db_item = NoUpdatedField.objects.get(pk=1)
         src_item = NoUpdatedField.objects.search.query('match', field_title='My title')[0]
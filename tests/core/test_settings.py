@@ -1,7 +1,13 @@
 from django.conf import settings
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils.six import StringIO
+from elasticsearch.exceptions import ConnectionError
 
 from bungiesearch import Bungiesearch
+from bungiesearch.breaker import (CircuitBreaker, CircuitBreakerOpen,
+                                  ClusterUnhealthy)
+from bungiesearch.connections import registry
 
 
 class SettingsTestCase(TestCase):
@@ -12,3 +18,78 @@ class SettingsTestCase(TestCase):
 
         self.assertEqual(search.BUNGIE['TIMEOUT'], 29)
         self.assertEqual(search._using.transport.kwargs['timeout'], 29)
+
+    def test_connection_registry(self):
+        settings.BUNGIESEARCH['CONNECTION'] = {'MAXSIZE': 15}
+        try:
+            search = Bungiesearch()
+            self.assertIs(search._using, Bungiesearch()._using)
+            self.assertEqual(search._using.transport.kwargs['maxsize'], 15)
+            self.assertTrue(search.ping())
+
+            # Forked processes must not reuse the clients of their parent.
+            registry.reset()
+            self.assertIsNot(search._using, Bungiesearch()._using)
+        finally:
+            del settings.BUNGIESEARCH['CONNECTION']
+
+    def test_health_check_backoff(self):
+        client = registry.get(('unreachable.example.com',), ['unreachable.example.com'], 1)
+        pings = []
+        ping, registry.ping = registry.ping, lambda client: pings.append(client) or False
+        settings.BUNGIESEARCH['CONNECTION'] = {'HEALTH_CHECK': True}
+        try:
+            self.assertFalse(registry.check_health(client))
+            self.assertFalse(registry.check_health(client))
+            self.assertEqual(len(pings), 1, 'Cluster was pinged again during the backoff.')
+            # Searches fail fast rather than waiting for the timeout of the cluster.
+            self.assertRaises(ClusterUnhealthy, Bungiesearch._call_es, client, client.search)
+            self.assertEqual(len(pings), 1)
+        finally:
+            registry.ping = ping
+            registry.reset()
+            del settings.BUNGIESEARCH['CONNECTION']
+
+    def test_read_write_urls(self):
+        settings.BUNGIESEARCH['WRITE_URLS'] = ['write.example.com']
+        settings.BUNGIESEARCH['INDEX_URLS'] = {'bungiesearch_demo': {'READ': ['read.example.com']}}
+        try:
+            search = Bungiesearch().index('bungiesearch_demo')
+            self.assertEqual(search._read_search()._using.transport.hosts, [{'host': 'read.example.com'}])
+            self.assertEqual(Bungiesearch().index('bungiesearch_demo_bis')._read_search()._using, search._using)
+            self.assertEqual(Bungiesearch.get_write_es_instance('bungiesearch_demo').transport.hosts, [{'host': 'write.example.com'}])
+        finally:
+            del settings.BUNGIESEARCH['WRITE_URLS']
+            del settings.BUNGIESEARCH['INDEX_URLS']
+
+    def test_circuit_breaker(self):
+        def unavailable():
+            raise ConnectionError('N/A', 'Connection refused.')
+
+        breaker = CircuitBreaker(failures=2, window=30, reset_timeout=30)
+        for _ in range(2):
+            self.assertRaises(ConnectionError, breaker.call, unavailable)
+        self.assertTrue(breaker.is_open)
+        self.assertRaises(CircuitBreakerOpen, breaker.call, lambda: True)
+
+    def test_lazy_model_indices(self):
+        instances = Bungiesearch._idx_name_to_mdl_to_mdlidx['bungiesearch_demo']
+        instance = instances.pop('User', None)
+        try:
+            self.assertIn('bungiesearch_demo', Bungiesearch.get_index('User'))
+            self.assertNotIn('User', instances, 'Looking up the index of a model instantiated its ModelIndex.')
+        finally:
+            if instance is not None:
+                instances['User'] = instance
+
+    def test_startup_report(self):
+        models = Bungiesearch.get_models('bungiesearch_demo_bis')
+        self.assertIn('bungiesearch_demo_bis', Bungiesearch._loaded_indices)
+        self.assertRaises(KeyError, Bungiesearch.get_models, 'undefined_index')
+
+        out = StringIO()
+        call_command('search_startup', stdout=out)
+        self.assertEqual(set(Bungiesearch._loaded_indices), set(Bungiesearch.get_indices()))
+        self.assertIn('core.search_indices_bis', out.getvalue())
+        self.assertIn('bungiesearch_demo_bis.{}'.format(Bungiesearch.get_model_indices('bungiesearch_demo_bis')[0].__class__.__name__), out.getvalue())
+        self.assertEqual(models, Bungiesearch.get_models('bungiesearch_demo_bis'))